@@ -0,0 +1,385 @@
+"""Benchmarks performance sensitive steps of the pipelines."""
+from __future__ import absolute_import
+
+import BaseHTTPServer
+import gzip
+import os
+import shutil
+import SocketServer
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from koch import db
+from koch import fetch
+from koch import http
+from koch import parse
+from koch import table
+from koch import tf_idf
+from koch import vocab
+from koch.proto import document_pb2
+from koch.proto import util
+
+FLAGS = flags.FLAGS
+flags.DEFINE_multi_string("benchmark", [], "Names of benchmarks to run.")
+flags.DEFINE_string(
+    "benchmark_dir", None, "Scratch directory, a temporary one if unset.")
+
+flags.DEFINE_integer("benchmark_records", 100000, "Number of records to use.")
+flags.DEFINE_integer("benchmark_value_size", 1024, "Size of values in bytes.")
+flags.DEFINE_integer("benchmark_requests", 1000, "Number of http requests.")
+flags.DEFINE_string(
+    "benchmark_pages", None,
+    "Path of fetched documents to parse, generated pages if unset.")
+flags.DEFINE_integer(
+    "benchmark_startups", 5, "Number of times to start each entry point.")
+flags.DEFINE_float(
+    "benchmark_connect_delay", 0.0,
+    "Seconds the test server waits on new connections, to model handshakes.")
+
+
+def timed(name, count, fn, *args, **kwargs):
+  start = time.time()
+  out = fn(*args, **kwargs)
+  elapsed = time.time() - start
+  logging.info(
+      "%s: %d records in %.3fs (%.1f records/s)",
+      name, count, elapsed, count / max(elapsed, 1e-9))
+  return out
+
+
+def write_records(writer, records):
+  with writer:
+    for key, value in records:
+      writer.write(key, value)
+
+
+def db_writes(scratch):
+  """Compares unbatched and batched LevelDB writes."""
+  n = FLAGS.benchmark_records
+  records = [
+      ("%016d" % i, os.urandom(FLAGS.benchmark_value_size)) for i in range(n)]
+
+  modes = [
+    ("unbatched", {}),
+    ("batched", db.batch_options()),
+    ("batched sync", dict(db.batch_options(), sync=True)),
+  ]
+  for name, options in modes:
+    path = os.path.join(scratch, "db_writes_%s" % name.replace(" ", "_"))
+    timed(name, n, write_records, db.DbWriter(path, **options), records)
+
+
+def get_store_records(kind):
+  """Returns records shaped like those of the stores of a LevelDB profile."""
+  rand = np.random.RandomState(0)
+  n = FLAGS.benchmark_records
+  if kind == "keywords":
+    keywords = (
+      document_pb2.Keyword(word="word%d" % i, doc_count=rank, total_doc_count=n)
+      for i, rank in enumerate(rand.zipf(1.2, n)))
+    values = [keyword.SerializeToString() for keyword in keywords]
+  elif kind == "blobs":
+    values = [
+      os.urandom(8 * FLAGS.benchmark_value_size) for _ in xrange(n // 20)]
+  else:
+    words = ["<p>", "</p>", "<div class=\"content\">", "</div>"] + [
+      "word%d" % i for i in xrange(5000)]
+    values = []
+    for _ in xrange(n // 20):
+      ids = rand.zipf(1.2, FLAGS.benchmark_value_size) % len(words)
+      values.append(" ".join(words[i] for i in ids))
+
+  keys = ["%016d" % i for i in rand.permutation(len(values))]
+  return zip(keys, values)
+
+
+def scan_records(reader):
+  with reader:
+    return sum(1 for _ in reader)
+
+
+def get_records(reader, keys):
+  with reader:
+    return sum(1 for key in keys if reader.get(key) is not None)
+
+
+def get_disk_size(path):
+  return sum(
+      os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def db_profiles(scratch):
+  """Compares LevelDB profiles on records shaped like those of each store.
+
+  Records are written in random key order, then scanned, then half of them and
+  as many missing keys are read by point lookups.
+  """
+  rand = np.random.RandomState(1)
+  for kind in sorted(db.PROFILES):
+    records = get_store_records(kind)
+    keys = [key for key, _ in records[:len(records) // 2]]
+    keys += ["%016d" % (i + len(records)) for i in xrange(len(keys))]
+    keys = [keys[i] for i in rand.permutation(len(keys))]
+
+    for profile in [None] + sorted(db.PROFILES):
+      name = "%s records, %s profile" % (kind, profile or "default")
+      path = os.path.join(scratch, "%s_%s" % (kind, profile))
+      timed(name + " writes", len(records), write_records,
+            db.DbWriter(path, profile=profile, **db.batch_options()), records)
+      timed(name + " scans", len(records), scan_records,
+            db.DbReader(path, profile=profile))
+      timed(name + " lookups", len(keys), get_records,
+            db.DbReader(path, profile=profile), keys)
+      logging.info("%s: %d bytes on disk", name, get_disk_size(path))
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves gzip encoded pages over keep-alive connections."""
+
+  protocol_version = "HTTP/1.1"
+  wbufsize = -1
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    time.sleep(self.server.connect_delay)
+
+  def do_GET(self):
+    body = self.server.page
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html; charset=utf-8")
+    if "gzip" in self.headers.get("Accept-Encoding", ""):
+      body = self.server.gzipped_page
+      self.send_header("Content-Encoding", "gzip")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    return
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+
+  def __init__(self, page, connect_delay=0.0):
+    BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), PageHandler)
+    self.page = page
+    self.connect_delay = connect_delay
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+      f.write(page)
+    self.gzipped_page = buf.getvalue()
+
+
+def request_all(requester, urls):
+  for url in urls:
+    requester(url)
+
+
+def fetch_clients(scratch):
+  """Compares a connection per request with pooled keep-alive connections."""
+  n = FLAGS.benchmark_requests
+  page = "<p>%s</p>" % ("word " * (FLAGS.benchmark_value_size // 5))
+  server = PageServer(page, FLAGS.benchmark_connect_delay)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  try:
+    urls = [
+        "http://127.0.0.1:%d/page/%d" % (server.server_port, i)
+        for i in range(n)]
+    timed("urllib2", n, request_all, http.request, urls)
+    with http.ConnectionPool() as pool:
+      timed("pooled", n, request_all, pool.request, urls)
+  finally:
+    server.shutdown()
+    server.server_close()
+
+
+def get_pages():
+  """Returns the raw html of saved pages, or of generated ones."""
+  if FLAGS.benchmark_pages:
+    reader = db.ProtoDbReader(
+        document_pb2.Document, FLAGS.benchmark_pages, profile="documents")
+    with reader:
+      return [doc.raw_html.html for _, doc in reader]
+
+  paragraph = "<p>%s</p>" % (
+      "The quick brown fox jumps over the lazy dog. " * 5)
+  page = (
+      "<html><head><title>Page</title><script>var x = 1;</script></head>"
+      "<body><div id='nav'><ul>%s</ul></div><div id='main'>%s</div>"
+      "</body></html>") % ("<li><a href='#'>Item</a></li>" * 20, paragraph * 50)
+  return [page.decode("utf-8")] * 100
+
+
+def parse_pages(parser, pages):
+  for html in pages:
+    doc = document_pb2.Document()
+    doc.raw_html.html = html
+    fetch.parse_html(doc, parser=parser)
+
+
+def html_parsers(scratch):
+  """Compares parsing pages with each html parser."""
+  pages = get_pages()
+  for name in sorted(fetch.PARSERS):
+    timed(name, len(pages), parse_pages, fetch.PARSERS[name], pages)
+
+
+def parse_docs(parsing, docs):
+  parsed = []
+  for doc in docs:
+    copy = document_pb2.Document()
+    copy.CopyFrom(doc)
+    parsed.extend(value for _, value in parsing.pipe(str(doc.url), copy))
+  return parsed
+
+
+def parse_words(scratch):
+  """Compares tagging blob by blob with batched and cached tagging."""
+  docs = []
+  for html in get_pages():
+    doc = document_pb2.Document()
+    doc.raw_html.html = html
+    docs.append(fetch.parse_html(doc, extract=True, parser=fetch.parse_lxml))
+
+  tokens = 0
+  for doc in docs:
+    blobs = document_pb2.Document()
+    for i, elm in enumerate(doc.content_html.elements):
+      parse.build_blobs(elm, blobs, [i])
+    tokens += sum(len(blob.text.split()) for blob in blobs.blobs)
+
+  outputs = []
+  for name, batched in [("unbatched", False), ("batched", True)]:
+    parsing = parse.ParsingPipeline(
+        FLAGS.parse_pos, None, batched=batched,
+        cache_size=FLAGS.parse_cache_size)
+    outputs.append(timed(name, tokens, parse_docs, parsing, docs))
+
+  if outputs[0] != outputs[1]:
+    logging.warning("Batched words differ from unbatched words")
+
+
+def get_parsed_docs():
+  """Returns documents of blobs of words drawn from a zipfian vocab."""
+  rand = np.random.RandomState(0)
+  docs = []
+  for i in xrange(FLAGS.benchmark_records // 100):
+    doc = document_pb2.Document(url="http://localhost/%d" % i)
+    for _ in xrange(20):
+      blob = doc.blobs.add()
+      for j, rank in enumerate(rand.zipf(1.2, 25)):
+        blob.words.add(index=j, text="word%d" % (rank % 50000))
+    docs.append(doc)
+  return docs
+
+
+def count_words(values):
+  for value in values:
+    doc = document_pb2.Document.FromString(value)
+    util.CountWords(doc)
+
+
+def word_encodings(scratch):
+  """Compares reading words stored in blobs with compact token arrays."""
+  docs = get_parsed_docs()
+  tokens = sum(len(blob.words) for doc in docs for blob in doc.blobs)
+  for name, compact in [("blobs", False), ("compact", True)]:
+    values = []
+    for doc in docs:
+      if compact:
+        util.EncodeWords(doc)
+      values.append(doc.SerializeToString())
+    logging.info("%s: %d bytes", name, sum(len(value) for value in values))
+    timed(name, tokens, count_words, values)
+
+
+def score_docs(scoring, docs):
+  with scoring.idf_reader:
+    for doc in docs:
+      copy = document_pb2.Document()
+      copy.CopyFrom(doc)
+      list(scoring.pipe(str(doc.url), copy))
+
+
+def tf_idf_scoring(scratch):
+  """Compares scoring tf-idf word by word with scoring vocab ids as arrays."""
+  docs = get_parsed_docs()
+  corpus = vocab.CorpusVocab()
+  for doc in docs:
+    corpus.add(doc)
+  path = os.path.join(scratch, "vocab")
+  corpus.build().save(path)
+
+  for name, scoring in [
+      ("words", tf_idf.DocumentTfIdfPipeline),
+      ("ids", tf_idf.TableTfIdfPipeline)]:
+    timed(name, len(docs), score_docs,
+          scoring(0.0, table.KeywordReader(path), None), docs)
+
+
+_ENTRY_POINTS = [
+  "benchmark", "eval", "extract", "fetch", "naive_bayes", "parse", "sample",
+  "stream", "text_rank", "tf_idf",
+]
+
+
+def start(command, env, count):
+  for _ in xrange(count):
+    subprocess.check_call(command, env=env)
+
+
+def startup(scratch):
+  """Times importing each entry point in a fresh interpreter."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  for name in _ENTRY_POINTS:
+    command = [sys.executable, "-c", "import koch.%s" % name]
+    timed(name, FLAGS.benchmark_startups, start, command, env,
+          FLAGS.benchmark_startups)
+
+
+_BENCHMARKS = {
+  "db_profiles": db_profiles,
+  "db_writes": db_writes,
+  "fetch_clients": fetch_clients,
+  "html_parsers": html_parsers,
+  "parse_words": parse_words,
+  "startup": startup,
+  "tf_idf_scoring": tf_idf_scoring,
+  "word_encodings": word_encodings,
+}
+
+
+def main(argv):
+  unknown = set(FLAGS.benchmark) - set(_BENCHMARKS)
+  if unknown:
+    raise app.UsageError("Unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+
+  scratch = FLAGS.benchmark_dir or tempfile.mkdtemp()
+  try:
+    for name in FLAGS.benchmark or sorted(_BENCHMARKS):
+      logging.info("Running benchmark %s", name)
+      path = os.path.join(scratch, name)
+      os.makedirs(path)
+      _BENCHMARKS[name](path)
+  finally:
+    if not FLAGS.benchmark_dir:
+      shutil.rmtree(scratch)
+
+
+if __name__ == "__main__":
+  app.run(main)
@@ -0,0 +1,80 @@
+"""Weighs and scores html trees to find their main content.
+
+Trees are flattened in pre-order with an explicit stack, so that weighing,
+scoring and finding the best subtree are flat loops rather than recursive
+walks, and deep trees don't hit the recursion limit.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+_positive = "pos"
+_negative = "neg"
+
+
+def text_len(string):
+  if string.isspace():
+    return 0
+  else:
+    return len(string)
+
+
+def measure_pos(html_element):
+  return text_len(html_element.text) + text_len(html_element.tail)
+
+
+def measure_neg(html_element):
+  return 2 * len(html_element.tag) + len(str(html_element.attrib or ""))
+
+
+def iter_html_elements(html_element):
+  """Yields html_element and its descendants in pre-order."""
+  stack = [html_element]
+  while stack:
+    html_element = stack.pop()
+    yield html_element
+    stack.extend(reversed(html_element.children))
+
+
+class WeightedTree(object):
+  """Flattens a tree in pre-order with the weights and scores of its subtrees.
+
+  The subtree of the node at index i spans indices [i, i + sizes[i]).
+  """
+
+  def __init__(self, root, children, pos=measure_pos, neg=measure_neg):
+    self.nodes = []
+    parents = []
+    stack = [(root, -1)]
+    while stack:
+      node, parent = stack.pop()
+      parents.append(parent)
+      self.nodes.append(node)
+      i = len(self.nodes) - 1
+      stack.extend((child, i) for child in reversed(children(node)))
+
+    self.sizes = [1] * len(self.nodes)
+    self.pos = map(pos, self.nodes)
+    self.neg = map(neg, self.nodes)
+    for i in xrange(len(self.nodes) - 1, 0, -1):
+      parent = parents[i]
+      self.sizes[parent] += self.sizes[i]
+      self.pos[parent] += self.pos[i]
+      self.neg[parent] += self.neg[i]
+
+    # Weights and scores are rounded like the float fields they are stored in.
+    pos = np.array(self.pos, dtype=np.float32).astype(np.float64)
+    neg = np.array(self.neg, dtype=np.float32).astype(np.float64)
+    self.scores = (pos / (pos[0] or 1) - 2 * neg / (neg[0] or 1)).astype(
+        np.float32)
+
+  def best(self):
+    """Returns the index of the first highest scoring node."""
+    return int(np.argmax(self.scores))
+
+  def annotate(self, html_elements, start=0):
+    """Sets weights and scores of html_elements, nodes from index start."""
+    for i, html_element in enumerate(html_elements, start):
+      html_element.weight[_positive] = self.pos[i]
+      html_element.weight[_negative] = self.neg[i]
+      html_element.score = self.scores[i]
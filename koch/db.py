@@ -2,10 +2,89 @@
 from __future__ import absolute_import
 
 import csv
+import json
+import os
 import plyvel
 
+from absl import flags
 from absl import logging
 
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    "db_batch_size", 1000, "Records buffered per write batch, 0 to disable.")
+flags.DEFINE_integer(
+    "db_batch_bytes", 4 << 20, "Bytes buffered per write batch, 0 to disable.")
+flags.DEFINE_boolean("db_sync", False, "Whether to sync writes to disk.")
+flags.DEFINE_integer("db_shard_count", 1, "Number of shards to split inputs into.")
+flags.DEFINE_integer("db_shard_index", 0, "Index of the input shard to read.")
+flags.DEFINE_enum(
+    "db_join_mode", None, ["lookup", "hash", "merge"],
+    "How to join readers, chosen from the readers if unset.")
+flags.DEFINE_integer(
+    "db_join_hash_bytes", 256 << 20,
+    "Maximum size of a database to load into memory for a hash join.")
+
+# LevelDB options of each kind of store, chosen by how it is read and written.
+# Readers must use the profile of the writer for bloom filters to be used.
+PROFILES = {
+  # Large documents, written in bulk and mostly scanned, with some point
+  # lookups by joins and rewriters.
+  "documents": {
+    "compression": "snappy",
+    "block_size": 64 << 10,
+    "bloom_filter_bits": 10,
+    "lru_cache_size": 64 << 20,
+    "write_buffer_size": 16 << 20,
+    "max_file_size": 16 << 20,
+  },
+  # Small records, mostly read and rewritten by point lookups. Their stores
+  # are small enough that faster lookups are worth more than compression.
+  "keywords": {
+    "compression": None,
+    "block_size": 4 << 10,
+    "bloom_filter_bits": 10,
+    "lru_cache_size": 64 << 20,
+    "write_buffer_size": 8 << 20,
+    "max_file_size": 4 << 20,
+  },
+  # Large values that are already compressed, read by point lookups.
+  "blobs": {
+    "compression": None,
+    "block_size": 64 << 10,
+    "bloom_filter_bits": 10,
+    "lru_cache_size": 8 << 20,
+    "write_buffer_size": 16 << 20,
+    "max_file_size": 16 << 20,
+  },
+}
+
+
+def batch_options():
+  """Returns the DbWriter batching options set by flags."""
+  return {
+    "batch_size": FLAGS.db_batch_size,
+    "batch_bytes": FLAGS.db_batch_bytes,
+    "sync": FLAGS.db_sync,
+  }
+
+
+def get_options(profile, **kwargs):
+  """Returns the LevelDB options of profile, if any, overridden by kwargs."""
+  return dict(PROFILES[profile] if profile else {}, **kwargs)
+
+
+def join_options():
+  """Returns the JoiningReader options set by flags."""
+  return {"mode": FLAGS.db_join_mode, "hash_bytes": FLAGS.db_join_hash_bytes}
+
+
+def shard_options():
+  """Returns the DbReader sharding options set by flags."""
+  if FLAGS.db_shard_count > 1:
+    return {"shard": (FLAGS.db_shard_index, FLAGS.db_shard_count)}
+  return {}
+
+
 class Manager(object):
 
   def __init__(self, ctor, *args, **kwargs):
@@ -30,6 +109,8 @@ class Manager(object):
 
 class Reader(object):
 
+  sorted = False
+
   def __init__(self, manager):
     self.manager = manager
 
@@ -51,11 +132,20 @@ class Reader(object):
 
 
 class JoiningReader(Reader):
+  """Joins the values of reader with the values of other_reader by key.
 
-  def __init__(self, reader, other_reader):
+  In lookup mode other_reader is read with one get per key. In hash mode it is
+  first loaded into memory. In merge mode both readers are scanned side by side,
+  which requires both to read keys in sorted order. If mode is unset, merge is
+  used when possible, then hash if other_reader is under hash_bytes on disk.
+  """
+
+  def __init__(self, reader, other_reader, mode=None, hash_bytes=256 << 20):
     super(JoiningReader, self).__init__(None)
     self.reader = reader
     self.other_reader = other_reader
+    self.mode = mode
+    self.hash_bytes = hash_bytes
 
   def __enter__(self):
     self.reader.__enter__()
@@ -67,28 +157,195 @@ class JoiningReader(Reader):
     self.other_reader.__exit__(*args)
 
   def __iter__(self):
+    mode = self.mode or self.choose_mode()
+    logging.info("Joining readers in %s mode", mode)
+    if mode == "merge":
+      return self.merge_join()
+    elif mode == "hash":
+      return self.hash_join()
+    else:
+      return self.lookup_join()
+
+  def choose_mode(self):
+    if not hasattr(self.other_reader, "scan"):
+      return "lookup"
+    elif getattr(self.reader, "sorted", False) and self.other_reader.sorted:
+      return "merge"
+    elif self.other_reader.size() <= self.hash_bytes:
+      return "hash"
+    else:
+      return "lookup"
+
+  def lookup_join(self):
     for key, value in self.reader:
       other_value = self.other_reader.get(key)
       yield key, (value, other_value)
 
+  def hash_join(self):
+    table = dict(self.other_reader.scan())
+    for key, value in self.reader:
+      other_value = self.other_reader.map(table.get(key))
+      yield key, (value, other_value)
+
+  def merge_join(self):
+    others = self.other_reader.scan()
+    other_key, other_raw = next(others, (None, None))
+    for key, value in self.reader:
+      while other_key is not None and other_key < key:
+        other_key, other_raw = next(others, (None, None))
+      other_value = self.other_reader.map(
+          other_raw if other_key == key else None)
+      yield key, (value, other_value)
+
+
+# Approximate sizes are too coarse to split databases smaller than this.
+_MIN_APPROXIMATE_SIZE = 64 << 20
+
+
+def _key_to_int(key, width):
+  return int(key.ljust(width, "\0")[:width].encode("hex"), 16)
+
+
+def _int_to_key(n, width):
+  return ("%0*x" % (2 * width, n)).decode("hex")
+
+
+def _sample_shard_boundaries(db, count):
+  with db.iterator(include_value=False) as it:
+    keys = list(it)
+  return [None] + [keys[len(keys) * i // count] for i in range(1, count)] + [None]
+
+
+def get_shard_boundaries(db, count):
+  """Returns count + 1 keys splitting db into count roughly equal key ranges.
+
+  Boundaries are found by bisecting the key space on LevelDB's approximate
+  sizes, or by sampling keys if the database is too small for those to be
+  accurate. The first and last boundaries are None so the shards cover every
+  key. Approximate sizes change as LevelDB compacts its files, so boundaries
+  computed by different readers of the same data may differ; use
+  load_or_compute_shard_boundaries to share them.
+  """
+  with db.iterator(include_value=False) as it:
+    first = next(it, None)
+  with db.iterator(include_value=False, reverse=True) as it:
+    last = next(it, None)
+
+  boundaries = [None] * (count + 1)
+  if first is None or count < 2:
+    return boundaries
+
+  width = max(len(first), len(last), 8)
+  low = _key_to_int(first, width)
+  end = _key_to_int(last, width) + 1
+  total = db.approximate_size(first, _int_to_key(end, width))
+  if total < _MIN_APPROXIMATE_SIZE:
+    return _sample_shard_boundaries(db, count)
+
+  for i in range(1, count):
+    target = total * i / float(count)
+    high = end
+    while low < high:
+      mid = (low + high) // 2
+      if db.approximate_size(first, _int_to_key(mid, width)) < target:
+        low = mid + 1
+      else:
+        high = mid
+    boundaries[i] = _int_to_key(low, width)
+
+  return boundaries
+
+
+def get_shard_boundaries_path(path):
+  """Returns the path of the saved shard boundaries of the database at path."""
+  return path.rstrip("/") + ".shards.json"
+
+
+def load_or_compute_shard_boundaries(path, db, count):
+  """Returns the shard boundaries of db, the database at path, for count shards.
+
+  The first reader to shard the database computes its boundaries and saves
+  them next to it, and later readers load them, so every shard agrees on the
+  same boundaries. If the database is rewritten, the saved boundaries still
+  cover every key, though the shards may no longer be even; delete the file to
+  recompute them.
+  """
+  boundaries_path = get_shard_boundaries_path(path)
+  saved = {}
+  if os.path.exists(boundaries_path):
+    with open(boundaries_path) as f:
+      saved = json.load(f)
+
+  if str(count) not in saved:
+    boundaries = get_shard_boundaries(db, count)
+    saved[str(count)] = [
+        key.encode("hex") if key is not None else None for key in boundaries]
+    with open(boundaries_path, "w") as f:
+      json.dump(saved, f)
+
+  return [
+      str(key).decode("hex") if key is not None else None
+      for key in saved[str(count)]]
+
 
 class DbReader(Reader):
+  """Reads a LevelDB, optionally restricted to a range of keys.
+
+  Keys from start up to but excluding stop are read. If shard is an (index,
+  count) pair, the range is instead the index-th of count roughly equal shards
+  of the database, computed by the first reader to shard it and saved next to
+  the database for the rest. The database is opened with the options of
+  profile, one of PROFILES, if set.
+
+  LevelDB locks a database while it is open, so shards read by separate
+  processes must be read one after another, or each from its own copy of the
+  database and its saved boundaries.
+  """
+
+  sorted = True
   
-  def __init__(self, path, **kwargs):
+  def __init__(
+      self, path, start=None, stop=None, shard=None, profile=None, **kwargs):
     super(DbReader, self).__init__(
-        Manager(plyvel.DB, path, **kwargs))
+        Manager(plyvel.DB, path, **get_options(profile, **kwargs)))
+    self.start = start
+    self.stop = stop
+    self.shard = shard
+
+  def __enter__(self):
+    super(DbReader, self).__enter__()
+    if self.shard:
+      index, count = self.shard
+      boundaries = load_or_compute_shard_boundaries(
+          self.manager.args[0], self.manager.db, count)
+      self.start, self.stop = boundaries[index], boundaries[index + 1]
+    return self
 
   def __iter__(self):
-    with self.manager.db.iterator() as it:
-      for key, value in it:
-        try:
-          yield key, self.map(value)
-        except:
-          logging.info("Found bad key: %s", key)
+    for key, value in self.scan():
+      try:
+        yield key, self.map(value)
+      except:
+        logging.info("Found bad key: %s", key)
+
+  def __contains__(self, key):
+    return self.manager.db.get(key) is not None
 
   def get(self, key):
     return self.map(self.manager.db.get(key))
 
+  def scan(self):
+    """Yields keys and unmapped values in key order."""
+    with self.manager.db.iterator(start=self.start, stop=self.stop) as it:
+      for key, value in it:
+        yield key, value
+
+  def size(self):
+    """Returns the size of the database files in bytes."""
+    path = self.manager.args[0]
+    return sum(
+        os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
 
 class ProtoDbReader(DbReader):
   
@@ -151,8 +408,24 @@ class Writer(object):
   def write(self, key, value):
     raise NotImplementedError
 
+  def delete(self, key):
+    raise NotImplementedError
+
+  def flush(self):
+    return
+
+  def peek(self, key):
+    """Returns the unflushed mapped value of key, if any."""
+    return None
+
 
 class DbWriter(Writer):
+  """Writes to a LevelDB, optionally buffering puts into write batches.
+
+  Batches are flushed once batch_size records or batch_bytes bytes are
+  buffered, and always on exit. Only the last value written to a key is kept.
+  The database is opened with the options of profile, one of PROFILES, if set.
+  """
 
   defaults = {
     "create_if_missing": True,
@@ -161,14 +434,60 @@ class DbWriter(Writer):
     "write_buffer_size": 2 << 20,
   }
 
-  def __init__(self, path, **kwargs):
+  def __init__(
+      self, path, batch_size=0, batch_bytes=0, sync=False, profile=None,
+      **kwargs):
     super(DbWriter, self).__init__(
         Manager(plyvel.DB, path, **dict(
-            DbWriter.defaults, **kwargs)))
+            DbWriter.defaults, **get_options(profile, **kwargs))))
+    self.batch_size = batch_size
+    self.batch_bytes = batch_bytes
+    self.sync = sync
+    self.batch = {}
+    self.batched_bytes = 0
+
+  def __exit__(self, *args):
+    if self.manager.db:
+      self.flush()
+    super(DbWriter, self).__exit__(*args)
 
   def write(self, key, value):
     self.manager.check()
-    self.manager.db.put(key, self.map(value))
+    value = self.map(value)
+    if not self.batch_size and not self.batch_bytes:
+      self.manager.db.put(key, value, sync=self.sync)
+      return
+
+    old_value = self.batch.get(key)
+    if old_value is not None:
+      self.batched_bytes -= len(key) + len(old_value)
+    self.batch[key] = value
+    self.batched_bytes += len(key) + len(value)
+
+    if (self.batch_size and len(self.batch) >= self.batch_size or
+        self.batch_bytes and self.batched_bytes >= self.batch_bytes):
+      self.flush()
+
+  def flush(self):
+    if not self.batch:
+      return
+
+    self.manager.check()
+    with self.manager.db.write_batch(sync=self.sync) as batch:
+      for key, value in self.batch.iteritems():
+        batch.put(key, value)
+    self.batch = {}
+    self.batched_bytes = 0
+
+  def delete(self, key):
+    self.manager.check()
+    value = self.batch.pop(key, None)
+    if value is not None:
+      self.batched_bytes -= len(key) + len(value)
+    self.manager.db.delete(key, sync=self.sync)
+
+  def peek(self, key):
+    return self.batch.get(key)
 
 
 class ProtoDbWriter(DbWriter):
@@ -233,12 +552,29 @@ class Rewriter(Reader, Writer):
     self.reader = reader
     self.writer = writer
 
+  def __enter__(self):
+    self.writer.__enter__()
+    return self
+
+  def __exit__(self, *args):
+    self.writer.__exit__(*args)
+
   def __iter__(self):
+    self.writer.flush()
     for out in self.reader:
       yield out
 
+  def __contains__(self, key):
+    return self.writer.peek(key) is not None or key in self.reader
+
   def get(self, key):
-    return self.reader.get(key)
+    value = self.writer.peek(key)
+    if value is None:
+      return self.reader.get(key)
+    return self.reader.map(value)
 
   def write(self, key, value):
     return self.writer.write(key, value)
+
+  def delete(self, key):
+    return self.writer.delete(key)
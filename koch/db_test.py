@@ -0,0 +1,286 @@
+"""Tests for koch.db."""
+from __future__ import absolute_import
+
+import json
+import os
+import plyvel
+
+from absl.testing import absltest
+
+from koch import db
+from koch.proto import document_pb2
+
+
+class DbWriterTest(absltest.TestCase):
+
+  def setUp(self):
+    super(DbWriterTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "db")
+
+  def read(self):
+    database = plyvel.DB(self.path)
+    try:
+      return list(database)
+    finally:
+      database.close()
+
+  def test_writes_without_batching(self):
+    with db.DbWriter(self.path) as writer:
+      writer.write("b", "2")
+      writer.write("a", "1")
+      self.assertEqual("1", writer.manager.db.get("a"))
+      self.assertIsNone(writer.peek("a"))
+
+    self.assertEqual([("a", "1"), ("b", "2")], self.read())
+
+  def test_flushes_full_batches(self):
+    with db.DbWriter(self.path, batch_size=2) as writer:
+      writer.write("a", "1")
+      self.assertIsNone(writer.manager.db.get("a"))
+      self.assertEqual("1", writer.peek("a"))
+
+      writer.write("b", "2")
+      self.assertEqual("1", writer.manager.db.get("a"))
+      self.assertIsNone(writer.peek("a"))
+
+      writer.write("c", "3")
+      self.assertIsNone(writer.manager.db.get("c"))
+
+    self.assertEqual([("a", "1"), ("b", "2"), ("c", "3")], self.read())
+
+  def test_flushes_batches_over_batch_bytes(self):
+    with db.DbWriter(self.path, batch_bytes=10) as writer:
+      writer.write("a", "1234")
+      self.assertIsNone(writer.manager.db.get("a"))
+      writer.write("b", "5678")
+      self.assertEqual("1234", writer.manager.db.get("a"))
+      self.assertEqual(0, writer.batched_bytes)
+
+  def test_keeps_last_value_of_batched_key(self):
+    with db.DbWriter(self.path, batch_size=3) as writer:
+      writer.write("a", "1")
+      writer.write("a", "22")
+      writer.write("b", "3")
+      self.assertEqual(2, len(writer.batch))
+      self.assertEqual(len("a22b3"), writer.batched_bytes)
+
+    self.assertEqual([("a", "22"), ("b", "3")], self.read())
+
+  def test_deletes_batched_key(self):
+    with db.DbWriter(self.path, batch_size=3) as writer:
+      writer.write("a", "1")
+      writer.write("b", "2")
+      writer.delete("a")
+
+    self.assertEqual([("b", "2")], self.read())
+
+  def test_rewriter_reads_unflushed_values(self):
+    rewriter = db.Rewriter(
+        db.DbReader(self.path), db.DbWriter(self.path, batch_size=10))
+    with rewriter:
+      rewriter.write("a", "1")
+      self.assertEqual("1", rewriter.get("a"))
+      self.assertIn("a", rewriter)
+      self.assertEqual([("a", "1")], list(rewriter))
+
+
+class ProfileTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ProfileTest, self).setUp()
+    self.tmp = self.create_tempdir().full_path
+
+  def test_applies_profile_options(self):
+    for profile, options in db.PROFILES.iteritems():
+      path = os.path.join(self.tmp, profile)
+      writer = db.DbWriter(path, profile=profile, error_if_exists=False)
+      self.assertDictContainsSubset(options, writer.manager.kwargs)
+      self.assertFalse(writer.manager.kwargs["error_if_exists"])
+      self.assertTrue(writer.manager.kwargs["create_if_missing"])
+      self.assertEqual(
+          options, db.DbReader(path, profile=profile).manager.kwargs)
+
+  def test_options_override_profiles(self):
+    writer = db.DbWriter(
+        self.tmp, profile="documents", compression=None, block_size=1024)
+    self.assertIsNone(writer.manager.kwargs["compression"])
+    self.assertEqual(1024, writer.manager.kwargs["block_size"])
+    self.assertEqual(
+        db.PROFILES["documents"]["write_buffer_size"],
+        writer.manager.kwargs["write_buffer_size"])
+    self.assertEqual(
+        db.DbWriter.defaults["write_buffer_size"],
+        db.DbWriter(self.tmp).manager.kwargs["write_buffer_size"])
+
+  def test_compresses_documents_only(self):
+    sizes = {}
+    for profile in db.PROFILES:
+      path = os.path.join(self.tmp, profile)
+      with db.DbWriter(path, profile=profile) as writer:
+        for i in range(1000):
+          writer.write("key%04d" % i, "abc" * 200)
+
+      # Reopening writes the log to a table, compressed by the profile.
+      with db.DbReader(path, profile=profile) as reader:
+        self.assertLen(list(reader), 1000)
+        sizes[profile] = reader.size()
+
+    self.assertLess(sizes["documents"] * 4, sizes["keywords"])
+    self.assertLess(sizes["documents"] * 4, sizes["blobs"])
+
+
+class ShardingTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ShardingTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "db")
+    self.keys = ["key%03d" % i for i in range(100)]
+    with db.DbWriter(self.path, batch_size=100) as writer:
+      for key in self.keys:
+        writer.write(key, key)
+
+  def read_shard(self, index, count):
+    with db.DbReader(self.path, shard=(index, count)) as reader:
+      return [key for key, _ in reader]
+
+  def test_shards_cover_every_key_once(self):
+    shards = [self.read_shard(i, 4) for i in range(4)]
+    self.assertEqual(self.keys, sum(shards, []))
+    for shard in shards:
+      self.assertNotEmpty(shard)
+
+  def test_single_shard_reads_everything(self):
+    self.assertEqual(self.keys, self.read_shard(0, 1))
+
+  def test_boundaries_are_unbounded_at_the_ends(self):
+    database = plyvel.DB(self.path)
+    try:
+      boundaries = db.get_shard_boundaries(database, 3)
+      self.assertEqual(boundaries, db.get_shard_boundaries(database, 3))
+    finally:
+      database.close()
+
+    self.assertLen(boundaries, 4)
+    self.assertIsNone(boundaries[0])
+    self.assertIsNone(boundaries[-1])
+    self.assertEqual(sorted(boundaries[1:-1]), boundaries[1:-1])
+
+  def test_empty_database_has_one_unbounded_shard(self):
+    path = os.path.join(self.create_tempdir().full_path, "empty")
+    database = plyvel.DB(path, create_if_missing=True)
+    try:
+      self.assertEqual([None] * 3, db.get_shard_boundaries(database, 2))
+    finally:
+      database.close()
+
+  def test_readers_share_saved_boundaries(self):
+    self.read_shard(0, 3)
+    with open(db.get_shard_boundaries_path(self.path), "w") as f:
+      boundaries = [None, "key010".encode("hex"), "key090".encode("hex"), None]
+      json.dump({"3": boundaries}, f)
+
+    self.assertEqual(self.keys[:10], self.read_shard(0, 3))
+    self.assertEqual(self.keys[10:90], self.read_shard(1, 3))
+    self.assertEqual(self.keys[90:], self.read_shard(2, 3))
+
+  def test_key_ints_round_trip(self):
+    for key in ["a", "key050", "\xff\x00z"]:
+      self.assertEqual(
+          key.ljust(8, "\0"), db._int_to_key(db._key_to_int(key, 8), 8))
+
+
+class ApproximateShardingTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ApproximateShardingTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "db")
+    self.keys = ["key%05d" % i for i in range(20000)]
+    with db.DbWriter(self.path, write_buffer_size=1 << 20) as writer:
+      for key in self.keys:
+        writer.write(key, key * 20)
+
+    # Split on approximate sizes however small the database is.
+    min_size = db._MIN_APPROXIMATE_SIZE
+    db._MIN_APPROXIMATE_SIZE = 0
+    self.addCleanup(setattr, db, "_MIN_APPROXIMATE_SIZE", min_size)
+
+  def test_bisects_approximate_sizes(self):
+    database = plyvel.DB(self.path)
+    try:
+      boundaries = db.get_shard_boundaries(database, 4)
+    finally:
+      database.close()
+
+    self.assertIsNone(boundaries[0])
+    self.assertIsNone(boundaries[-1])
+    self.assertEqual(sorted(boundaries[1:-1]), boundaries[1:-1])
+
+  def test_shards_cover_every_key_once(self):
+    shards = []
+    for i in range(4):
+      with db.DbReader(self.path, shard=(i, 4)) as reader:
+        shards.append([key for key, _ in reader])
+
+    self.assertEqual(self.keys, sum(shards, []))
+    for shard in shards:
+      self.assertGreater(len(shard), len(self.keys) // 8)
+
+
+class JoiningReaderTest(absltest.TestCase):
+
+  def setUp(self):
+    super(JoiningReaderTest, self).setUp()
+    tmp = self.create_tempdir().full_path
+    self.docs_path = os.path.join(tmp, "docs")
+    self.keywords_path = os.path.join(tmp, "keywords")
+    self.keys = ["a", "b", "c", "d", "e"]
+    with db.DbWriter(self.docs_path) as writer:
+      for key in self.keys:
+        writer.write(key, key.upper())
+    with db.ProtoDbWriter(document_pb2.Keyword, self.keywords_path) as writer:
+      for key, doc_count in [("0", 9), ("b", 2), ("d", 4), ("z", 1)]:
+        writer.write(key, document_pb2.Keyword(word=key, doc_count=doc_count))
+
+  def get_keywords(self):
+    return db.ProtoDbReader(document_pb2.Keyword, self.keywords_path)
+
+  def join(self, reader, **kwargs):
+    with db.JoiningReader(reader, self.get_keywords(), **kwargs) as joining:
+      return [
+          (key, value, keyword.doc_count)
+          for key, (value, keyword) in joining]
+
+  def test_join_modes_agree(self):
+    expected = [
+      ("a", "A", 0), ("b", "B", 2), ("c", "C", 0), ("d", "D", 4), ("e", "E", 0),
+    ]
+    for mode in ("lookup", "hash", "merge"):
+      self.assertEqual(
+          expected, self.join(db.DbReader(self.docs_path), mode=mode), mode)
+
+  def test_hash_join_of_unsorted_reader(self):
+    keys = ["d", "a", "b"]
+    reader = db.DebugReader(keys, [key.upper() for key in keys])
+    self.assertEqual(
+        [("d", "D", 4), ("a", "A", 0), ("b", "B", 2)],
+        self.join(reader, mode="hash"))
+
+  def test_chooses_merge_for_sorted_readers(self):
+    joining = db.JoiningReader(
+        db.DbReader(self.docs_path), self.get_keywords())
+    self.assertEqual("merge", joining.choose_mode())
+
+  def test_chooses_hash_or_lookup_by_size(self):
+    with self.get_keywords() as keywords:
+      joining = db.JoiningReader(db.DebugReader([]), keywords)
+      self.assertEqual("hash", joining.choose_mode())
+      joining.hash_bytes = 0
+      self.assertEqual("lookup", joining.choose_mode())
+
+  def test_chooses_lookup_without_scan(self):
+    joining = db.JoiningReader(db.DebugReader([]), db.DebugReader([]))
+    self.assertEqual("lookup", joining.choose_mode())
+
+
+if __name__ == "__main__":
+  absltest.main()
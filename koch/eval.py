@@ -12,7 +12,7 @@ from absl import app
 from absl import flags
 
 from koch import db
-from koch import parse
+from koch import outputs
 from koch import pipeline
 from koch.proto import document_pb2
 from koch.proto import util
@@ -87,7 +87,8 @@ def main(argv):
 
   reader = db.JoiningReader(
       eval_reader, db.ProtoDbReader(
-          document_pb2.Document, FLAGS.parse_output))
+          document_pb2.Document, FLAGS.parse_output, profile="documents"),
+      **db.join_options())
 
   EvalPipeline(reader, db.DebugWriter()).run()
 
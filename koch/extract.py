@@ -1,7 +1,6 @@
 """Extracts main article body.
 
 TODO:
- - build protos more efficiently
  - compare body extraction methods
  - retain all tail text
 """
@@ -10,69 +9,30 @@ from __future__ import absolute_import
 from absl import app
 from absl import flags
 
+from koch import content
 from koch import db
-from koch import fetch
+from koch import outputs
 from koch import pipeline
 from koch.proto import document_pb2
 
 FLAGS = flags.FLAGS
-flags.DEFINE_string("extract_output", None, "Output path to write parsed html to.")
-
 flags.DEFINE_boolean("extract_debug", False, "Whether to use the debug writer.")
 
 
-def text_len(string):
-  if string.isspace():
-    return 0
-  else:
-    return len(string)
-
- 
-def measure_pos(html_element):
-  return text_len(html_element.text) + text_len(html_element.tail)
-
-
-def measure_neg(html_element):
-  return 2 * len(html_element.tag) + len(str(html_element.attrib or ""))
-
-
-_positive = "pos"
-_negative = "neg"
-
+def find_best_elements(html_element, annotate_all=False):
+  """Returns the best scoring subtree of html_element.
 
-def weight_html_element(html_element):
-  html_element.weight[_positive] = measure_pos(html_element)
-  html_element.weight[_negative] = measure_neg(html_element)
-  for child in html_element.children:
-    weighted_child = weight_html_element(child)
-    html_element.weight[_positive] += weighted_child.weight[_positive]
-    html_element.weight[_negative] += weighted_child.weight[_negative]
-  return html_element
-
-
-def score_normalized(html_element, pos, neg):
-  node_pos = html_element.weight[_positive] / pos
-  node_neg = html_element.weight[_negative] / neg
-  html_element.score = node_pos - 2 * node_neg
-  for child in html_element.children:
-    score_normalized(child, pos, neg)
-  return html_element
-
- 
-def score(html_element):
-  pos = html_element.weight[_positive] or 1
-  neg = html_element.weight[_negative] or 1
-  return score_normalized(html_element, pos, neg)
-
-
-def find_best_elements(html_element):
-  best = document_pb2.HtmlElements(
-    elements=[html_element], score=html_element.score)
-  for child in html_element.children:
-    child_best = find_best_elements(child)
-    if best.score < child_best.score:
-      best = child_best
-  return best
+  Only the weights and scores of the returned subtree are set, unless
+  annotate_all is set.
+  """
+  tree = content.WeightedTree(html_element, lambda e: e.children)
+  i = tree.best()
+  if annotate_all:
+    tree.annotate(tree.nodes)
+  else:
+    tree.annotate(tree.nodes[i:i + tree.sizes[i]], i)
+  return document_pb2.HtmlElements(
+    elements=[tree.nodes[i]], score=tree.scores[i])
 
 
 class ExtractionPipeline(pipeline.Pipeline):
@@ -83,11 +43,9 @@ class ExtractionPipeline(pipeline.Pipeline):
   
   def pipe(self, key, value):
     doc = value
-    html_elements = find_best_elements(
-        score(weight_html_element(doc.parsed_html)))
-
-    doc.content_html.elements.extend(html_elements.elements)
-    doc.content_html.score = html_elements.score
+    if doc.HasField("parsed_html"):
+      html_elements = find_best_elements(doc.parsed_html, self.debug)
+      doc.content_html.CopyFrom(html_elements)
 
     if not self.debug:
       doc.ClearField("raw_html")
@@ -97,13 +55,19 @@ class ExtractionPipeline(pipeline.Pipeline):
   
 
 def main(argv):
-  reader = db.ProtoDbReader(document_pb2.Document, FLAGS.fetch_output)
-  writer = db.ProtoDbWriter(document_pb2.Document, FLAGS.extract_output)
+  reader = db.ProtoDbReader(
+      document_pb2.Document, FLAGS.fetch_output, profile="documents",
+      **db.shard_options())
+  writer = db.ProtoDbWriter(
+      document_pb2.Document, FLAGS.extract_output, profile="documents",
+      **db.batch_options())
 
   if not FLAGS.extract_output:
     writer = db.DebugWriter()
 
-  ExtractionPipeline(reader, writer, FLAGS.extract_debug).run()
+  extraction = ExtractionPipeline(reader, writer, FLAGS.extract_debug)
+  extraction.executor = pipeline.default_executor()
+  extraction.run()
  
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+"""Tests for koch.extract and koch.content."""
+from __future__ import absolute_import
+
+import random
+
+from absl.testing import absltest
+
+from koch import content
+from koch import extract
+from koch.proto import document_pb2
+
+
+def weigh_recursively(html_element):
+  """The recursive weighing that WeightedTree replaced."""
+  html_element.weight["pos"] = content.measure_pos(html_element)
+  html_element.weight["neg"] = content.measure_neg(html_element)
+  for child in html_element.children:
+    weigh_recursively(child)
+    html_element.weight["pos"] += child.weight["pos"]
+    html_element.weight["neg"] += child.weight["neg"]
+
+
+def score_recursively(html_element, pos, neg):
+  html_element.score = (
+      html_element.weight["pos"] / pos - 2 * html_element.weight["neg"] / neg)
+  for child in html_element.children:
+    score_recursively(child, pos, neg)
+
+
+def find_best_recursively(html_element):
+  best = document_pb2.HtmlElements(
+      elements=[html_element], score=html_element.score)
+  for child in html_element.children:
+    child_best = find_best_recursively(child)
+    if best.score < child_best.score:
+      best = child_best
+  return best
+
+
+def find_best_elements_recursively(html_element):
+  weigh_recursively(html_element)
+  score_recursively(
+      html_element, html_element.weight["pos"] or 1,
+      html_element.weight["neg"] or 1)
+  return find_best_recursively(html_element)
+
+
+def make_random_tree(seed, size=200):
+  rng = random.Random(seed)
+  root = document_pb2.HtmlElement(tag="html")
+  elements = [root]
+  for _ in range(size):
+    element = rng.choice(elements).children.add(
+        tag=rng.choice(["div", "p", "span", "a", "article"]),
+        text=rng.choice(["", " ", "some text", "x" * rng.randint(1, 500)]),
+        tail=rng.choice(["", "\n", "tail"]))
+    if rng.random() < 0.3:
+      element.attrib["class"] = rng.choice(["nav", "content", "footer"])
+    elements.append(element)
+  return root
+
+
+def copy(html_element):
+  new_element = document_pb2.HtmlElement()
+  new_element.CopyFrom(html_element)
+  return new_element
+
+
+class FindBestElementsTest(absltest.TestCase):
+
+  def test_matches_recursive_extraction(self):
+    for seed in range(20):
+      tree = make_random_tree(seed)
+      expected_tree = copy(tree)
+      expected = find_best_elements_recursively(expected_tree)
+
+      self.assertEqual(expected, extract.find_best_elements(tree))
+      # Annotating every node reproduces the recursive weights and scores.
+      extract.find_best_elements(tree, annotate_all=True)
+      self.assertEqual(expected_tree, tree)
+
+  def test_annotates_only_the_best_subtree(self):
+    tree = make_random_tree(0)
+    best = extract.find_best_elements(tree)
+    self.assertNotEqual(best.elements[0], tree)
+    self.assertFalse(tree.weight)
+    self.assertTrue(best.elements[0].weight)
+
+  def test_finds_best_elements_of_deep_trees(self):
+    root = document_pb2.HtmlElement(tag="html")
+    html_element = root
+    for i in range(5000):
+      html_element = html_element.children.add(tag="div", tail=" ")
+    html_element.text = "the only text"
+
+    best = extract.find_best_elements(root)
+    self.assertEqual("the only text", best.elements[0].text)
+    self.assertEqual(len("the only text"), best.elements[0].weight["pos"])
+
+  def test_weighs_any_tree(self):
+    tree = content.WeightedTree(
+        ("a", [("b", []), ("c", [("d", [])])]), lambda node: node[1],
+        pos=lambda node: 1, neg=lambda node: len(node[0]))
+    self.assertEqual(["a", "b", "c", "d"], [node[0] for node in tree.nodes])
+    self.assertEqual([4, 1, 2, 1], tree.sizes)
+    self.assertEqual([4, 1, 2, 1], tree.pos)
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -1,31 +1,37 @@
-"""Fetches raw html content from urls.
-
-TODO:
- - multithreaded requests
- - side output for failed urls
-"""
+"""Fetches raw html content from urls."""
 from __future__ import absolute_import
 
 import contextlib
 import csv
+import functools
 import html5lib
-import pandas as pd
 import random
 import re2
+import threading
+import time
 import urllib2
+import urlparse
 
 from absl import app
 from absl import flags
 from absl import logging
 
+try:
+  import lxml.html
+except ImportError:
+  lxml = None
+
+from koch import content
 from koch import db
+from koch import http
+from koch import outputs
 from koch import pipeline
 from koch import sample
+from koch.proto import crawl_pb2
 from koch.proto import document_pb2
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string("fetch_input", None, "Input path to csv of urls to fetch.")
-flags.DEFINE_string("fetch_output", None, "Output path to write fetched html to.")
 flags.DEFINE_multi_string("fetch_debug", None, "Input urls to debug.")
 
 flags.DEFINE_string(
@@ -37,30 +43,77 @@ flags.DEFINE_string(
 flags.DEFINE_multi_string(
     "fetch_metadata_column", [], "Names of csv metadata columns to retain.")
 
-_HEADERS = {
-  "User-Agent": "Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11"
-}
+flags.DEFINE_integer("fetch_workers", 1, "Number of concurrent fetches.")
+flags.DEFINE_integer(
+    "fetch_parse_processes", 1, "Number of processes to parse html with.")
+flags.DEFINE_integer(
+    "fetch_parse_chunk_size", 4, "Number of pages sent to a process at once.")
+flags.DEFINE_enum(
+    "fetch_parser", "html5lib", ["html5lib", "lxml"],
+    "Library to parse html with. lxml is faster, but omits empty elements "
+    "html5lib adds, like head, which changes content scores; html5lib is "
+    "used if lxml is unavailable or fails.")
+flags.DEFINE_integer(
+    "fetch_queue_size", None, "Maximum number of urls buffered in flight.")
+flags.DEFINE_integer(
+    "fetch_host_workers", 2, "Maximum number of concurrent fetches per host.")
+flags.DEFINE_float(
+    "fetch_host_qps", 0.0, "Maximum fetches per second per host, if positive.")
+flags.DEFINE_boolean(
+    "fetch_extract", False,
+    "Whether to extract content html instead of writing parsed html.")
+
+flags.DEFINE_string(
+    "fetch_state", None,
+    "Path of the crawl state to resume from, fetching only new urls and "
+    "retrying failures.")
+flags.DEFINE_integer(
+    "fetch_max_retries", 3, "Maximum number of times to retry a failed url.")
+flags.DEFINE_float(
+    "fetch_retry_backoff", 3600.0,
+    "Seconds to wait before retrying a failed url, doubled for each retry.")
+
+flags.DEFINE_enum(
+    "fetch_client", "pooled", ["pooled", "urllib2"],
+    "Whether to reuse connections to hosts or open one per url.")
+flags.DEFINE_float("fetch_timeout", 30.0, "Seconds to wait on a connection.")
+flags.DEFINE_integer(
+    "fetch_max_bytes", 32 << 20, "Maximum size of a page, 0 for no limit.")
+
+flags.DEFINE_string("fetch_cache", None, "Path of a cache of responses to use.")
+flags.DEFINE_integer(
+    "fetch_cache_ttl", 24 * 60 * 60,
+    "Seconds to serve cached responses for before revalidating them.")
+flags.DEFINE_integer(
+    "fetch_cache_bytes", 1 << 30,
+    "Maximum bytes of cached responses to keep, 0 for no limit.")
+
+_WHITESPACE = re2.compile(r"\s+")
+
+
+def download(url, requester=http.request):
+  """Returns the html at url encoded as utf-8, raising if it can't."""
+  response = requester(url)
+  logging.info("Fetched url %s", url)
+  encoding = response.charset or "UTF-8"
+  for en in (encoding, "ISO-8859-1", "Windows-1252", "ASCII"):
+    try:
+      return response.body.decode(en).encode("utf-8")
+    except Exception as e:
+      continue
+  else:
+    raise ValueError("Unknown encoding %s" % encoding)
 
 
-def fetch(url):
+def fetch(url, requester=http.request):
   try:
-    r = urllib2.Request(url, headers=_HEADERS)
-    with contextlib.closing(urllib2.urlopen(r)) as conn:
-      html = conn.read()
-      logging.info("Fetched url %s", url)
-      encoding = conn.headers.getparam("charset") or "UTF-8"
-      for en in (encoding, "ISO-8859-1", "Windows-1252", "ASCII"):
-        try:
-          return html.decode(en).encode("utf-8")
-        except Exception as e:
-          continue
-      else:
-        raise ValueError
+    return download(url, requester)
   except Exception as e:
     logging.warning("Failed url %s: %s", url, str(e))
 
 
 def to_epoch(string, format="%m/%d/%Y", unit="1s"):
+  import pandas as pd  # Slow to import, and only needed for dates.
   date = pd.to_datetime(string, format=format)
   return int((date - pd.Timestamp(0)) / pd.Timedelta(unit))
 
@@ -76,7 +129,7 @@ def is_valid(html):
 
 def get_text(string):
   if string and not string.isspace():
-    return re2.sub(r"\s+", " ", string)
+    return _WHITESPACE.sub(" ", string)
   else:
     return ""
 
@@ -91,14 +144,164 @@ def to_html_element(html, proto):
   return proto
 
 
+def get_children(html):
+  return [child for child in html if is_valid(child)]
+
+
 def build_html_element(html, proto):
-  proto = to_html_element(html, proto)
-  for child in html:
-    if is_valid(child):
-      build_html_element(child, proto.children.add())
+  root = proto
+  stack = [(html, proto)]
+  while stack:
+    html, proto = stack.pop()
+    to_html_element(html, proto)
+    children = get_children(html)
+    protos = [proto.children.add() for _ in children]
+    stack.extend(reversed(zip(children, protos)))
+  return root
+
+
+def measure_pos(html):
+  return (
+      content.text_len(get_text(html.text)) +
+      content.text_len(get_text(html.tail)))
+
+
+def measure_neg(html):
+  attrib = {
+    unicode(key): unicode(val)
+    for key, val in html.attrib.iteritems() if key != "style"}
+  return 2 * len(html.tag) + len(str(attrib or ""))
+
+
+def parse_html5lib(html):
+  return html5lib.parse(html, treebuilder="etree", namespaceHTMLElements=False)
+
+
+def parse_lxml(html):
+  """Parses html with lxml, falling back to html5lib if it can't."""
+  if not lxml:
+    return parse_html5lib(html)
+
+  data = html.encode("utf-8") if isinstance(html, unicode) else html
+  try:
+    return lxml.html.document_fromstring(
+        data, parser=lxml.html.HTMLParser(encoding="utf-8"))
+  except Exception as e:
+    logging.info("Parsing with html5lib, lxml failed: %s", str(e))
+    return parse_html5lib(html)
+
+
+PARSERS = {
+  "html5lib": parse_html5lib,
+  "lxml": parse_lxml,
+}
+
+
+def parse_html(doc, extract=False, parser=parse_html5lib):
+  """Parses the raw html of doc, only into its content html if extract."""
+  tree = parser(doc.raw_html.html)
+  if extract:
+    build_content_html(tree, doc.content_html)
+  else:
+    build_html_element(tree, doc.parsed_html)
+  return doc
+
+
+def build_content_html(html, proto):
+  """Builds only the best scoring subtree of html into proto."""
+  tree = content.WeightedTree(html, get_children, measure_pos, measure_neg)
+  i = tree.best()
+  element = build_html_element(tree.nodes[i], proto.elements.add())
+  tree.annotate(content.iter_html_elements(element), i)
+  proto.score = tree.scores[i]
   return proto
 
 
+class HostThrottle(object):
+  """Limits the number and rate of concurrent requests to each host."""
+
+  def __init__(self, max_workers, qps=0.0):
+    self.max_workers = max_workers
+    self.interval = 1.0 / qps if qps > 0 else 0.0
+    self.lock = threading.Lock()
+    self.semaphores = {}
+    self.next_times = {}
+
+  def wrap(self, fetcher):
+    def throttled(url, *args, **kwargs):
+      with self.hold(url):
+        return fetcher(url, *args, **kwargs)
+    return throttled
+
+  @contextlib.contextmanager
+  def hold(self, url):
+    host = urlparse.urlparse(url).netloc
+    with self.lock:
+      if host not in self.semaphores:
+        self.semaphores[host] = threading.BoundedSemaphore(self.max_workers)
+      semaphore = self.semaphores[host]
+
+    with semaphore:
+      with self.lock:
+        now = time.time()
+        start = max(now, self.next_times.get(host, now))
+        self.next_times[host] = start + self.interval
+      time.sleep(start - now)
+      yield
+
+
+class CrawlState(object):
+  """Records the outcome of fetching each url, so fetching can resume.
+
+  Failed urls are retried up to max_retries times, once backoff seconds have
+  passed since their last attempt, doubling after every further failure.
+  """
+
+  def __init__(self, path, max_retries=3, backoff=3600.0):
+    self.statuses = db.Rewriter(
+        db.ProtoDbReader(crawl_pb2.FetchStatus, path, profile="keywords"),
+        db.ProtoDbWriter(
+            crawl_pb2.FetchStatus, path, error_if_exists=False,
+            profile="keywords"))
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.lock = threading.Lock()
+
+  def __enter__(self):
+    self.statuses.__enter__()
+    return self
+
+  def __exit__(self, *args):
+    self.statuses.__exit__(*args)
+
+  def get(self, url):
+    with self.lock:
+      return self.statuses.get(url)
+
+  def should_fetch(self, url, now=None):
+    status = self.get(url)
+    if status.state != crawl_pb2.FetchStatus.FAILED:
+      return True
+    elif status.attempts > self.max_retries:
+      return False
+
+    delay = self.backoff * 2 ** (status.attempts - 1)
+    return (now or time.time()) >= status.last_attempt.seconds + delay
+
+  def record(self, url, reason=None):
+    """Records an attempt to fetch url, as failed if reason is given."""
+    with self.lock:
+      status = self.statuses.get(url)
+      status.url = url
+      status.state = (
+          crawl_pb2.FetchStatus.FAILED if reason else
+          crawl_pb2.FetchStatus.DONE)
+      status.reason = reason or ""
+      status.attempts += 1
+      status.last_attempt.seconds = int(time.time())
+      self.statuses.write(url, status)
+
+
 class UrlFilterPipeline(pipeline.Pipeline):
 
   def __init__(self, pattern, reader, writer=None):
@@ -130,13 +333,49 @@ class UrlRewritePipeline(pipeline.Pipeline):
     yield url, value
 
 
+class ResumingPipeline(pipeline.Pipeline):
+  """Filters out urls already in output or not due to be retried.
+
+  Output is read but not entered, as it is the writer of the fetching pipeline.
+  """
+
+  def __init__(self, output, state, reader, writer=None):
+    super(ResumingPipeline, self).__init__(reader, writer)
+    self.output = output
+    self.state = state
+
+  def pipe(self, key, value):
+    if key not in self.output and self.state.should_fetch(key):
+      yield key, value
+
+
 class FetchingPipeline(pipeline.Pipeline):
+  """Fetches the raw html of urls.
+
+  If state is set, urls are fetched with fetcher raising on failure, and the
+  outcome of every url is recorded in state. Failed urls are not written.
+  Resources used by fetcher are entered and exited with the pipeline.
+  """
 
   def __init__(
-      self, date_column, metadata_columns, reader, writer=None):
+      self, date_column, metadata_columns, reader, writer=None, fetcher=None,
+      state=None, resources=()):
     super(FetchingPipeline, self).__init__(reader, writer)
     self.date_column = date_column
     self.metadata_columns = metadata_columns
+    self.fetcher = fetcher or fetch
+    self.state = state
+    self.resources = resources
+
+  def __enter__(self):
+    for resource in self.resources:
+      resource.__enter__()
+    return super(FetchingPipeline, self).__enter__()
+
+  def __exit__(self, *args):
+    super(FetchingPipeline, self).__exit__(*args)
+    for resource in reversed(self.resources):
+      resource.__exit__(*args)
 
   def pipe(self, key, value):
     doc = document_pb2.Document()
@@ -147,19 +386,36 @@ class FetchingPipeline(pipeline.Pipeline):
         doc.metadata[col] = value[col]
 
     doc.raw_html.url = key
-    doc.raw_html.html = fetch(key) or ""
-
-    tree = html5lib.parse(
-        doc.raw_html.html, treebuilder="etree", namespaceHTMLElements=False)
-    build_html_element(tree, doc.parsed_html)
+    if not self.state:
+      doc.raw_html.html = self.fetcher(key) or ""
+    else:
+      try:
+        doc.raw_html.html = self.fetcher(key)
+      except Exception as e:
+        logging.warning("Failed url %s: %s", key, str(e))
+        self.state.record(key, str(e) or type(e).__name__)
+        return
+      self.state.record(key)
 
     yield key, doc
 
 
-def main(argv):
+class HtmlParsingPipeline(pipeline.Pipeline):
+  """Parses the raw html of fetched documents."""
+
+  def __init__(self, reader, writer=None, extract=False, parser=None):
+    super(HtmlParsingPipeline, self).__init__(reader, writer)
+    self.extract = extract
+    self.parser = parser or parse_html5lib
+
+  def pipe(self, key, value):
+    yield key, parse_html(value, self.extract, self.parser)
+
+
+def get_url_reader():
+  """Returns the reader of urls to fetch set by flags."""
   reader = UrlRewritePipeline(
       db.CsvReader(FLAGS.fetch_input, FLAGS.fetch_url_column))
-  writer = db.ProtoDbWriter(document_pb2.Document, FLAGS.fetch_output)
 
   if FLAGS.fetch_url_pattern:
     reader = UrlFilterPipeline(FLAGS.fetch_url_pattern, reader)
@@ -171,11 +427,76 @@ def main(argv):
   if FLAGS.fetch_debug:
     reader = db.DebugReader(FLAGS.fetch_debug)
 
+  return reader
+
+
+def get_fetching_pipeline(reader, writer=None, state=None):
+  """Returns a pipeline fetching and parsing the urls of reader.
+
+  Pages are downloaded by a pool of threads and parsed by a pool of processes,
+  connected by a queue of at most --fetch_queue_size pages.
+  """
+  resources = []
+  requester = http.request
+  if FLAGS.fetch_client == "pooled":
+    pool = http.ConnectionPool(
+        FLAGS.fetch_timeout, FLAGS.fetch_max_bytes, FLAGS.fetch_host_workers)
+    resources.append(pool)
+    requester = pool.request
+
+  throttle = HostThrottle(FLAGS.fetch_host_workers, FLAGS.fetch_host_qps)
+  requester = throttle.wrap(requester)
+
+  if FLAGS.fetch_cache:
+    cache = http.ResponseCache(
+        FLAGS.fetch_cache, FLAGS.fetch_cache_ttl, FLAGS.fetch_cache_bytes)
+    resources.append(cache)
+    requester = cache.wrap(requester)
+
+  fetcher = functools.partial(download if state else fetch, requester=requester)
+  fetching = FetchingPipeline(
+      FLAGS.fetch_date_column, FLAGS.fetch_metadata_column, reader,
+      fetcher=fetcher, state=state, resources=resources)
+  fetching.executor = pipeline.ThreadExecutor(
+      FLAGS.fetch_workers, FLAGS.fetch_queue_size, pipeline.Meter("fetch"))
+
+  if FLAGS.fetch_parser == "lxml" and not lxml:
+    logging.warning("lxml is unavailable, parsing with html5lib instead")
+
+  parsing = HtmlParsingPipeline(
+      fetching, writer, FLAGS.fetch_extract, PARSERS[FLAGS.fetch_parser])
+  parsing.executor = pipeline.SerialExecutor(pipeline.Meter("parse"))
+  if FLAGS.fetch_parse_processes > 1:
+    parsing.executor = pipeline.ProcessExecutor(
+        FLAGS.fetch_parse_processes, FLAGS.fetch_parse_chunk_size,
+        meter=pipeline.Meter("parse"))
+
+  return parsing
+
+
+def main(argv):
+  writer = db.ProtoDbWriter(
+      document_pb2.Document, FLAGS.fetch_output, profile="documents",
+      **db.batch_options())
+
   if not FLAGS.fetch_output:
     writer = db.DebugWriter()
 
-  FetchingPipeline(
-      FLAGS.fetch_date_column, FLAGS.fetch_metadata_column, reader, writer).run()
+  if not FLAGS.fetch_state:
+    get_fetching_pipeline(get_url_reader(), writer).run()
+    return
+
+  writer = db.Rewriter(
+      db.ProtoDbReader(
+          document_pb2.Document, FLAGS.fetch_output, profile="documents"),
+      db.ProtoDbWriter(
+          document_pb2.Document, FLAGS.fetch_output, error_if_exists=False,
+          profile="documents", **db.batch_options()))
+  state = CrawlState(
+      FLAGS.fetch_state, FLAGS.fetch_max_retries, FLAGS.fetch_retry_backoff)
+  with state:
+    reader = ResumingPipeline(writer, state, get_url_reader())
+    get_fetching_pipeline(reader, writer, state).run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,235 @@
+"""Tests for koch.fetch."""
+from __future__ import absolute_import
+
+import calendar
+import os
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from koch import db
+from koch import fetch
+from koch import http
+from koch import pipeline
+from koch.proto import crawl_pb2
+from koch.proto import document_pb2
+
+FLAGS = flags.FLAGS
+
+_DATE_COLUMN = "date"
+
+
+class FakeFetcher(object):
+  """Returns html for urls, raising for those in failures."""
+
+  def __init__(self, failures=()):
+    self.failures = set(failures)
+    self.urls = []
+
+  def __call__(self, url):
+    self.urls.append(url)
+    if url in self.failures:
+      raise IOError("failed %s" % url)
+    return "<html><body>%s</body></html>" % url
+
+
+class CrawlStateTest(absltest.TestCase):
+
+  def setUp(self):
+    super(CrawlStateTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "state")
+
+  def test_fetches_unknown_and_done_urls(self):
+    with fetch.CrawlState(self.path) as state:
+      self.assertTrue(state.should_fetch("a"))
+      state.record("a")
+      self.assertEqual(crawl_pb2.FetchStatus.DONE, state.get("a").state)
+      self.assertTrue(state.should_fetch("a"))
+
+  def test_backs_off_failed_urls(self):
+    with fetch.CrawlState(self.path, max_retries=2, backoff=10.0) as state:
+      state.record("a", "timeout")
+      status = state.get("a")
+      self.assertEqual(crawl_pb2.FetchStatus.FAILED, status.state)
+      self.assertEqual("timeout", status.reason)
+      self.assertEqual(1, status.attempts)
+
+      last = status.last_attempt.seconds
+      self.assertFalse(state.should_fetch("a", last + 9))
+      self.assertTrue(state.should_fetch("a", last + 10))
+
+      state.record("a", "timeout")
+      last = state.get("a").last_attempt.seconds
+      self.assertFalse(state.should_fetch("a", last + 19))
+      self.assertTrue(state.should_fetch("a", last + 20))
+
+      state.record("a", "timeout")
+      self.assertFalse(state.should_fetch("a", last + 1e9))
+
+  def test_persists_across_runs(self):
+    with fetch.CrawlState(self.path) as state:
+      state.record("a")
+      state.record("b", "timeout")
+
+    with fetch.CrawlState(self.path) as state:
+      self.assertEqual(crawl_pb2.FetchStatus.DONE, state.get("a").state)
+      self.assertEqual(crawl_pb2.FetchStatus.FAILED, state.get("b").state)
+      self.assertEqual(
+          crawl_pb2.FetchStatus.UNKNOWN, state.get("c").state)
+
+
+class ResumeTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ResumeTest, self).setUp()
+    tmp = self.create_tempdir().full_path
+    self.output_path = os.path.join(tmp, "fetched")
+    self.state_path = os.path.join(tmp, "state")
+    self.urls = ["http://example.com/%d" % i for i in range(4)]
+
+  def crawl(self, fetcher, backoff=3600.0):
+    """Fetches self.urls as fetch.main does with --fetch_state."""
+    writer = db.Rewriter(
+        db.ProtoDbReader(document_pb2.Document, self.output_path),
+        db.ProtoDbWriter(
+            document_pb2.Document, self.output_path, error_if_exists=False))
+    reader = db.DebugReader(
+        self.urls, [{_DATE_COLUMN: "01/02/2019"} for _ in self.urls])
+    with fetch.CrawlState(self.state_path, backoff=backoff) as state:
+      resuming = fetch.ResumingPipeline(writer, state, reader)
+      fetch.FetchingPipeline(
+          _DATE_COLUMN, [], resuming, writer, fetcher, state).run()
+
+    with db.ProtoDbReader(document_pb2.Document, self.output_path) as fetched:
+      return [key for key, _ in fetched]
+
+  def test_resumes_with_new_and_failed_urls(self):
+    first = FakeFetcher(failures=self.urls[1:3])
+    self.assertEqual([self.urls[0], self.urls[3]], self.crawl(first))
+    self.assertEqual(self.urls, first.urls)
+
+    # Fetched urls are skipped, and failures are not yet due to be retried.
+    second = FakeFetcher()
+    self.assertEqual([self.urls[0], self.urls[3]], self.crawl(second))
+    self.assertEqual([], second.urls)
+
+    third = FakeFetcher(failures=self.urls[2:3])
+    self.assertEqual(
+        [self.urls[0], self.urls[1], self.urls[3]],
+        self.crawl(third, backoff=0.0))
+    self.assertEqual(self.urls[1:3], third.urls)
+
+  def test_records_fetched_documents(self):
+    self.crawl(FakeFetcher())
+    with db.ProtoDbReader(document_pb2.Document, self.output_path) as fetched:
+      doc = fetched.get(self.urls[0])
+    self.assertEqual(self.urls[0], doc.url)
+    self.assertIn(self.urls[0], doc.raw_html.html)
+    self.assertEqual(
+        calendar.timegm((2019, 1, 2, 0, 0, 0)), doc.timestamp.seconds)
+
+
+_PAGE = (
+    u"<!DOCTYPE html><html><head><title>T</title><style>s</style></head>"
+    u"<body><!-- c --><div class='a' style='x'><p>Hello <b>world</b>  tail\n"
+    u"</p><script>x</script><p>Two</p><iframe src='y'></iframe></div>"
+    u"<p>caf\xe9</p></body></html>")
+
+
+def parse(html, parser, extract=False):
+  doc = document_pb2.Document()
+  doc.raw_html.html = html
+  return fetch.parse_html(doc, extract, parser)
+
+
+class ParserTest(absltest.TestCase):
+
+  def test_lxml_matches_html5lib(self):
+    for extract in (False, True):
+      self.assertEqual(
+          parse(_PAGE, fetch.parse_html5lib, extract),
+          parse(_PAGE, fetch.parse_lxml, extract))
+
+  def test_lxml_filters_elements(self):
+    body = parse(_PAGE, fetch.parse_lxml).parsed_html.children[1]
+    div, p = body.children
+    self.assertEqual({"class": "a"}, dict(div.attrib))
+    self.assertEqual(["p", "p"], [child.tag for child in div.children])
+    self.assertEqual(" tail ", div.children[0].children[0].tail)
+    self.assertEqual(u"caf\xe9", p.text)
+
+  def test_lxml_falls_back_to_html5lib(self):
+    for html in (u"", u"  "):
+      self.assertEqual(
+          parse(html, fetch.parse_html5lib), parse(html, fetch.parse_lxml))
+
+  @flagsaver.flagsaver
+  def test_parses_with_html5lib_by_default(self):
+    reader = db.DebugReader([])
+    self.assertIs(
+        fetch.parse_html5lib, fetch.get_fetching_pipeline(reader).parser)
+    FLAGS.fetch_parser = "lxml"
+    self.assertIs(fetch.parse_lxml, fetch.get_fetching_pipeline(reader).parser)
+
+
+class FetchingPipelineTest(absltest.TestCase):
+
+  def setUp(self):
+    super(FetchingPipelineTest, self).setUp()
+    self.urls = ["http://example.com/%d" % i for i in range(6)]
+
+  def get_reader(self):
+    return db.DebugReader(
+        self.urls, [{_DATE_COLUMN: "01/02/2019"} for _ in self.urls])
+
+  def fetch(self, processes):
+    fetching = fetch.FetchingPipeline(
+        _DATE_COLUMN, [], self.get_reader(), fetcher=FakeFetcher())
+    fetching.executor = pipeline.ThreadExecutor(3, 2)
+    parsing = fetch.HtmlParsingPipeline(fetching)
+    if processes > 1:
+      parsing.executor = pipeline.ProcessExecutor(processes, chunk_size=2)
+    with parsing:
+      return {key: doc for key, doc in parsing}
+
+  def test_parses_in_processes(self):
+    parsed = self.fetch(1)
+    self.assertCountEqual(self.urls, parsed)
+    body = parsed[self.urls[0]].parsed_html.children[1]
+    self.assertEqual("body", body.tag)
+    self.assertEqual(self.urls[0], body.text)
+    self.assertEqual(parsed, self.fetch(3))
+
+  @flagsaver.flagsaver
+  def test_sizes_stages_with_flags(self):
+    FLAGS.fetch_workers = 3
+    FLAGS.fetch_queue_size = 5
+    FLAGS.fetch_parse_processes = 2
+    FLAGS.fetch_parse_chunk_size = 7
+    parsing = fetch.get_fetching_pipeline(self.get_reader())
+    fetching = parsing.reader
+
+    self.assertIsInstance(fetching, fetch.FetchingPipeline)
+    self.assertIsInstance(fetching.executor, pipeline.ThreadExecutor)
+    self.assertEqual(
+        (3, 5, "fetch"),
+        (fetching.executor.workers, fetching.executor.queue_size,
+         fetching.executor.meter.name))
+    self.assertIsInstance(parsing.executor, pipeline.ProcessExecutor)
+    self.assertEqual(
+        (2, 7, "parse"),
+        (parsing.executor.processes, parsing.executor.chunk_size,
+         parsing.executor.meter.name))
+    self.assertEqual(
+        [http.ConnectionPool], [type(r) for r in fetching.resources])
+
+    FLAGS.fetch_parse_processes = 1
+    FLAGS.fetch_client = "urllib2"
+    parsing = fetch.get_fetching_pipeline(self.get_reader())
+    self.assertIsInstance(parsing.executor, pipeline.SerialExecutor)
+    self.assertEqual([], parsing.reader.resources)
+
+
+if __name__ == "__main__":
+  absltest.main()
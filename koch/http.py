@@ -0,0 +1,341 @@
+"""Requests urls over http, optionally through a cache of responses."""
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import hashlib
+import httplib
+import os
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+
+from absl import logging
+
+from koch import db
+from koch.proto import crawl_pb2
+
+_HEADERS = {
+  "User-Agent": "Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11"
+}
+
+_DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+_CONNECTIONS = {
+  "http": httplib.HTTPConnection,
+  "https": httplib.HTTPSConnection,
+}
+_REDIRECTS = (301, 302, 303, 307, 308)
+_READ_SIZE = 64 << 10
+
+
+class Response(object):
+  """The body of a response with the headers needed to decode and cache it."""
+
+  def __init__(
+      self, url, body, status=200, charset=None, etag=None, last_modified=None):
+    self.url = url
+    self.body = body
+    self.status = status
+    self.charset = charset
+    self.etag = etag
+    self.last_modified = last_modified
+
+
+def from_headers(url, body, headers, status=200):
+  return Response(
+      url, body, status, headers.getparam("charset"), headers.get("ETag"),
+      headers.get("Last-Modified"))
+
+
+def request(url, headers=None):
+  """Returns the response to a GET of url, raising on errors other than 304."""
+  r = urllib2.Request(url, headers=dict(_HEADERS, **(headers or {})))
+  try:
+    with contextlib.closing(urllib2.urlopen(r)) as conn:
+      return from_headers(url, conn.read(), conn.headers, conn.getcode())
+  except urllib2.HTTPError as e:
+    if e.code != 304:
+      raise
+    return from_headers(url, "", e.headers, e.code)
+
+
+def decode(body, encoding, max_bytes=0):
+  """Returns body decoded from a gzip or deflate content encoding."""
+  if not body:
+    return body
+  elif encoding == "gzip":
+    wbits = 16 + zlib.MAX_WBITS
+  elif encoding == "deflate":
+    wbits = zlib.MAX_WBITS if body[:1] == "\x78" else -zlib.MAX_WBITS
+  else:
+    return body
+
+  if not max_bytes:
+    return zlib.decompress(body, wbits)
+
+  decoded = zlib.decompressobj(wbits).decompress(body, max_bytes + 1)
+  if len(decoded) > max_bytes:
+    raise IOError("Body is over %d bytes" % max_bytes)
+  return decoded
+
+
+class ConnectionPool(object):
+  """Requests urls over persistent connections, reused across requests.
+
+  Up to max_idle idle connections are kept for each host. Responses are
+  decoded if gzip or deflate encoded, redirects are followed, and bodies of
+  over max_bytes are refused. Errors other than 304 raise IOError.
+  """
+
+  def __init__(self, timeout=30.0, max_bytes=0, max_idle=4, max_redirects=5):
+    self.timeout = timeout
+    self.max_bytes = max_bytes
+    self.max_idle = max_idle
+    self.max_redirects = max_redirects
+    self.lock = threading.Lock()
+    self.idle = collections.defaultdict(list)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    with self.lock:
+      for conns in self.idle.itervalues():
+        for conn in conns:
+          conn.close()
+      self.idle.clear()
+
+  def acquire(self, host):
+    """Returns an idle connection to host or a new one, and if it was idle."""
+    with self.lock:
+      if self.idle[host]:
+        return self.idle[host].pop(), True
+
+    scheme, netloc = host
+    if scheme not in _CONNECTIONS:
+      raise IOError("Unsupported scheme %s" % scheme)
+    return _CONNECTIONS[scheme](netloc, timeout=self.timeout), False
+
+  def release(self, host, conn):
+    with self.lock:
+      if len(self.idle[host]) < self.max_idle:
+        self.idle[host].append(conn)
+        return
+    conn.close()
+
+  def request(self, url, headers=None):
+    """Returns the response to a GET of url."""
+    for _ in xrange(self.max_redirects + 1):
+      r, body = self.send(url, headers)
+      location = r.getheader("Location")
+      if r.status in _REDIRECTS and location:
+        url = urlparse.urljoin(url, location)
+        continue
+
+      if r.status != 200 and r.status != 304:
+        raise IOError("HTTP %d %s from %s" % (r.status, r.reason, url))
+      return from_headers(url, body, r.msg, r.status)
+
+    raise IOError("Too many redirects from %s" % url)
+
+  def send(self, url, headers=None):
+    """Returns the response to a GET of url and its body, decoded if a 200."""
+    parts = urlparse.urlsplit(url)
+    host = (parts.scheme.lower(), parts.netloc.lower())
+    path = urlparse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    headers = dict(_HEADERS, **(headers or {}))
+    headers["Accept-Encoding"] = "gzip, deflate"
+
+    while True:
+      conn, reused = self.acquire(host)
+      try:
+        conn.request("GET", path, headers=headers)
+        r = conn.getresponse()
+        body = self.read(r)
+        break
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        # Idle connections may have been closed by the server, so retry those.
+        if not reused:
+          raise
+      except:
+        conn.close()
+        raise
+
+    if r.will_close:
+      conn.close()
+    else:
+      self.release(host, conn)
+
+    # Redirects, 304s and errors are never used, and often have empty bodies
+    # despite their Content-Encoding, so only 200s are decoded.
+    if r.status != 200:
+      return r, body
+    return r, decode(body, r.getheader("Content-Encoding"), self.max_bytes)
+
+  def read(self, r):
+    length = r.getheader("Content-Length")
+    if self.max_bytes and length and int(length) > self.max_bytes:
+      raise IOError("Body is over %d bytes" % self.max_bytes)
+
+    chunks = []
+    size = 0
+    while True:
+      chunk = r.read(_READ_SIZE)
+      if not chunk:
+        return "".join(chunks)
+      chunks.append(chunk)
+      size += len(chunk)
+      if self.max_bytes and size > self.max_bytes:
+        raise IOError("Body is over %d bytes" % self.max_bytes)
+
+
+def normalize_url(url):
+  """Returns url with a lowercase scheme and host, without default port."""
+  parts = urlparse.urlsplit(url)
+  scheme = parts.scheme.lower()
+  netloc = parts.netloc.lower()
+  port = _DEFAULT_PORTS.get(scheme)
+  if port and netloc.endswith(port):
+    netloc = netloc[:-len(port)]
+  return urlparse.urlunsplit(
+      (scheme, netloc, parts.path or "/", parts.query, ""))
+
+
+def get_key(url):
+  return hashlib.sha1(normalize_url(url)).hexdigest()
+
+
+class ResponseCache(object):
+  """Caches responses on disk, keyed by a hash of their normalized url.
+
+  Responses fetched less than ttl seconds ago are served from the cache, and
+  older ones are revalidated with a conditional request. Bodies are stored
+  compressed, and the least recently used responses are evicted once more than
+  max_bytes of bodies are stored.
+  """
+
+  def __init__(self, path, ttl=0, max_bytes=0):
+    self.path = path
+    self.responses = db.Rewriter(
+        db.ProtoDbReader(
+            crawl_pb2.CachedResponse, os.path.join(path, "responses"),
+            profile="keywords"),
+        db.ProtoDbWriter(
+            crawl_pb2.CachedResponse, os.path.join(path, "responses"),
+            error_if_exists=False, profile="keywords"))
+    self.bodies = db.Rewriter(
+        db.DbReader(os.path.join(path, "bodies"), profile="blobs"),
+        db.DbWriter(
+            os.path.join(path, "bodies"), error_if_exists=False,
+            profile="blobs"))
+    self.ttl = ttl
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.sizes = collections.OrderedDict()
+    self.size = 0
+    self.counts = collections.Counter()
+
+  def __enter__(self):
+    if not os.path.exists(self.path):
+      os.makedirs(self.path)
+    self.responses.__enter__()
+    self.bodies.__enter__()
+
+    self.sizes.clear()
+    self.size = 0
+    self.counts.clear()
+    entries = sorted(
+        (cached.accessed.seconds, key, cached.size)
+        for key, cached in self.responses)
+    for _, key, size in entries:
+      self.sizes[key] = size
+      self.size += size
+    return self
+
+  def __exit__(self, *args):
+    self.log_stats()
+    self.bodies.__exit__(*args)
+    self.responses.__exit__(*args)
+
+  def log_stats(self):
+    total = sum(self.counts.itervalues())
+    hits = self.counts["hits"] + self.counts["revalidations"]
+    logging.info(
+        "Response cache: %d hits, %d revalidated, %d misses (%.1f%% hit rate), "
+        "%d responses in %d bytes", self.counts["hits"],
+        self.counts["revalidations"], self.counts["misses"],
+        100.0 * hits / max(total, 1), len(self.sizes), self.size)
+
+  def wrap(self, requester):
+    def cached(url, headers=None):
+      return self.request(requester, url, headers)
+    return cached
+
+  def request(self, requester, url, headers=None):
+    """Returns the response to url, from the cache or else from requester."""
+    key = get_key(url)
+    cached = body = None
+    with self.lock:
+      if key in self.sizes:
+        cached = self.responses.get(key)
+        body = self.bodies.get(key)
+
+    now = int(time.time())
+    if cached is not None and now - cached.fetched.seconds < self.ttl:
+      return self.hit(key, cached, body, now, "hits")
+
+    headers = dict(headers or {})
+    if cached is not None and cached.etag:
+      headers["If-None-Match"] = cached.etag
+    if cached is not None and cached.last_modified:
+      headers["If-Modified-Since"] = cached.last_modified
+
+    response = requester(url, headers)
+    if cached is not None and response.status == 304:
+      cached.fetched.seconds = now
+      return self.hit(key, cached, body, now, "revalidations")
+
+    with self.lock:
+      self.counts["misses"] += 1
+      if response.status == 200:
+        self.put(key, response, now)
+    return response
+
+  def hit(self, key, cached, body, now, kind):
+    with self.lock:
+      self.counts[kind] += 1
+      if key in self.sizes:
+        cached.accessed.seconds = now
+        self.responses.write(key, cached)
+        self.sizes[key] = self.sizes.pop(key)
+
+    return Response(
+        cached.url, zlib.decompress(body), 200, cached.charset or None,
+        cached.etag or None, cached.last_modified or None)
+
+  def put(self, key, response, now):
+    body = zlib.compress(response.body)
+    cached = crawl_pb2.CachedResponse(
+        url=response.url, charset=response.charset or "",
+        etag=response.etag or "", last_modified=response.last_modified or "",
+        size=len(body))
+    cached.fetched.seconds = now
+    cached.accessed.seconds = now
+
+    self.bodies.write(key, body)
+    self.responses.write(key, cached)
+    self.size += len(body) - self.sizes.pop(key, 0)
+    self.sizes[key] = len(body)
+
+    while self.max_bytes and self.size > self.max_bytes:
+      key, size = self.sizes.popitem(last=False)
+      self.responses.delete(key)
+      self.bodies.delete(key)
+      self.size -= size
@@ -0,0 +1,261 @@
+"""Tests for koch.http."""
+from __future__ import absolute_import
+
+import BaseHTTPServer
+import SocketServer
+import os
+import threading
+import zlib
+
+from absl.testing import absltest
+
+from koch import http
+
+
+class FakeRequester(object):
+  """Returns the next of responses, recording the headers of each request."""
+
+  def __init__(self, *responses):
+    self.responses = list(responses)
+    self.requests = []
+
+  def __call__(self, url, headers=None):
+    self.requests.append((url, headers or {}))
+    response = self.responses.pop(0)
+    response.url = url
+    return response
+
+
+def ok(body, etag=None, last_modified=None):
+  return http.Response(None, body, 200, "utf-8", etag, last_modified)
+
+
+def not_modified():
+  return http.Response(None, "", 304)
+
+
+def gzip(body):
+  compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(body) + compressor.flush()
+
+
+def deflate_raw(body):
+  compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+  return compressor.compress(body) + compressor.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Serves canned responses on a local port, counting its connections.
+
+  routes maps paths to a status, headers and body. Connections are kept alive
+  unless the path is in hang_up, when they are closed without telling the
+  client, like an idle connection timing out.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, routes, hang_up=()):
+    BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+    self.routes = routes
+    self.hang_up = hang_up
+    self.connections = 0
+
+  def get_url(self, path):
+    return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+  def handle_error(self, request, client_address):
+    # Clients hang up on refused bodies.
+    pass
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+    self.server.connections += 1
+
+  def do_GET(self):
+    status, headers, body = self.server.routes[self.path]
+    self.send_response(status)
+    for name, value in headers.iteritems():
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    if self.path in self.server.hang_up:
+      self.close_connection = 1
+
+  def log_message(self, *args):
+    pass
+
+
+class ConnectionPoolTest(absltest.TestCase):
+
+  def serve(self, routes, hang_up=()):
+    server = Server(routes, hang_up)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    return server
+
+  def test_decodes_gzip_and_deflate(self):
+    body = "hello " * 100
+    server = self.serve({
+      "/gzip": (200, {"Content-Encoding": "gzip"}, gzip(body)),
+      "/deflate": (200, {"Content-Encoding": "deflate"}, zlib.compress(body)),
+      "/raw": (200, {"Content-Encoding": "deflate"}, deflate_raw(body)),
+      "/plain": (200, {}, body),
+    })
+    with http.ConnectionPool() as pool:
+      for path in ("/gzip", "/deflate", "/raw", "/plain"):
+        self.assertEqual(body, pool.request(server.get_url(path)).body)
+    self.assertEqual(1, server.connections)
+
+  def test_refuses_bodies_over_max_bytes(self):
+    server = self.serve({
+      "/small": (200, {"Content-Encoding": "gzip"}, gzip("x" * 100)),
+      "/bomb": (200, {"Content-Encoding": "gzip"}, gzip("x" * 1000)),
+      "/large": (200, {}, "x" * 1000),
+    })
+    with http.ConnectionPool(max_bytes=500) as pool:
+      self.assertEqual("x" * 100, pool.request(server.get_url("/small")).body)
+      for path in ("/bomb", "/large"):
+        with self.assertRaisesRegexp(IOError, "over 500 bytes"):
+          pool.request(server.get_url(path))
+
+  def test_follows_redirects(self):
+    server = self.serve({
+      "/old": (301, {"Location": "/new", "Content-Encoding": "gzip"}, ""),
+      "/new": (200, {"Content-Encoding": "gzip"}, gzip("moved")),
+      "/loop": (302, {"Location": "/loop"}, ""),
+    })
+    for max_bytes in (0, 100):
+      with http.ConnectionPool(max_bytes=max_bytes) as pool:
+        response = pool.request(server.get_url("/old"))
+        self.assertEqual(server.get_url("/new"), response.url)
+        self.assertEqual("moved", response.body)
+        with self.assertRaisesRegexp(IOError, "Too many redirects"):
+          pool.request(server.get_url("/loop"))
+
+  def test_returns_empty_not_modified_responses(self):
+    server = self.serve({
+      "/a": (304, {"Content-Encoding": "gzip", "ETag": "v1"}, ""),
+      "/missing": (404, {"Content-Encoding": "gzip"}, "not gzip"),
+    })
+    for max_bytes in (0, 100):
+      with http.ConnectionPool(max_bytes=max_bytes) as pool:
+        response = pool.request(server.get_url("/a"))
+        self.assertEqual(304, response.status)
+        self.assertEqual("", response.body)
+        self.assertEqual("v1", response.etag)
+        with self.assertRaisesRegexp(IOError, "HTTP 404"):
+          pool.request(server.get_url("/missing"))
+
+  def test_retries_connections_closed_while_idle(self):
+    server = self.serve(
+        {"/a": (200, {}, "a"), "/b": (200, {}, "b")}, hang_up=["/a"])
+    with http.ConnectionPool() as pool:
+      self.assertEqual("a", pool.request(server.get_url("/a")).body)
+      self.assertEqual("b", pool.request(server.get_url("/b")).body)
+    self.assertEqual(2, server.connections)
+
+
+class NormalizeUrlTest(absltest.TestCase):
+
+  def test_normalizes_scheme_host_and_port(self):
+    self.assertEqual(
+        "http://example.com/a?b=1",
+        http.normalize_url("HTTP://Example.COM:80/a?b=1#c"))
+    self.assertEqual(
+        "https://example.com:8443/",
+        http.normalize_url("https://example.com:8443"))
+    self.assertEqual(
+        http.get_key("http://example.com"), http.get_key("http://EXAMPLE.com/"))
+
+
+class ResponseCacheTest(absltest.TestCase):
+
+  def setUp(self):
+    super(ResponseCacheTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "cache")
+
+  def test_serves_fresh_responses_from_cache(self):
+    requester = FakeRequester(ok("hello", etag="v1"))
+    with http.ResponseCache(self.path, ttl=3600) as cache:
+      first = cache.request(requester, "http://example.com/a")
+      second = cache.request(requester, "http://EXAMPLE.com/a")
+
+    self.assertLen(requester.requests, 1)
+    self.assertEqual("hello", first.body)
+    self.assertEqual("hello", second.body)
+    self.assertEqual("utf-8", second.charset)
+    self.assertEqual("v1", second.etag)
+    self.assertEqual(1, cache.counts["hits"])
+    self.assertEqual(1, cache.counts["misses"])
+
+  def test_revalidates_stale_responses(self):
+    requester = FakeRequester(
+        ok("hello", etag="v1", last_modified="yesterday"), not_modified())
+    with http.ResponseCache(self.path, ttl=0) as cache:
+      cache.request(requester, "http://example.com/a")
+      response = cache.request(requester, "http://example.com/a")
+
+    self.assertEqual({}, requester.requests[0][1])
+    self.assertEqual(
+        {"If-None-Match": "v1", "If-Modified-Since": "yesterday"},
+        requester.requests[1][1])
+    self.assertEqual(200, response.status)
+    self.assertEqual("hello", response.body)
+    self.assertEqual(1, cache.counts["revalidations"])
+
+  def test_replaces_modified_responses(self):
+    requester = FakeRequester(ok("hello", etag="v1"), ok("bye", etag="v2"))
+    with http.ResponseCache(self.path, ttl=0) as cache:
+      cache.request(requester, "http://example.com/a")
+      response = cache.request(requester, "http://example.com/a")
+    self.assertEqual("bye", response.body)
+
+    requester = FakeRequester()
+    with http.ResponseCache(self.path, ttl=3600) as cache:
+      response = cache.request(requester, "http://example.com/a")
+    self.assertEqual("bye", response.body)
+    self.assertEqual("v2", response.etag)
+
+  def test_only_caches_ok_responses(self):
+    requester = FakeRequester(not_modified(), ok("hello"))
+    with http.ResponseCache(self.path, ttl=3600) as cache:
+      cache.request(requester, "http://example.com/a")
+      response = cache.request(requester, "http://example.com/a")
+    self.assertEqual("hello", response.body)
+    self.assertLen(requester.requests, 2)
+
+  def test_evicts_least_recently_used_responses(self):
+    bodies = {url: os.urandom(100) for url in "abc"}
+    requester = FakeRequester(*[ok(bodies[url]) for url in "abc"])
+    with http.ResponseCache(self.path, ttl=3600, max_bytes=250) as cache:
+      cache.request(requester, "http://example.com/a")
+      cache.request(requester, "http://example.com/b")
+      # Reading a makes b the least recently used response.
+      cache.request(requester, "http://example.com/a")
+      cache.request(requester, "http://example.com/c")
+      self.assertLen(cache.sizes, 2)
+      self.assertLessEqual(cache.size, 250)
+
+    with http.ResponseCache(self.path, ttl=3600) as cache:
+      self.assertCountEqual(
+          [http.get_key("http://example.com/" + url) for url in "ac"],
+          cache.sizes)
+      self.assertEqual(
+          bodies["c"], cache.request(requester, "http://example.com/c").body)
+      self.assertEqual(
+          bodies["b"], cache.request(
+              FakeRequester(ok(bodies["b"])), "http://example.com/b").body)
+      self.assertEqual(1, cache.counts["misses"])
+
+
+if __name__ == "__main__":
+  absltest.main()
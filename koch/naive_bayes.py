@@ -3,20 +3,24 @@
 TODO:
  - add check that doc doesn't have multiple labels
  - weight against words that don't appear in training
- - update main for out of sample prediction
 """
 from __future__ import absolute_import
 
 import math
+import numpy as np
 import re2
 
 from absl import app
 from absl import flags
 from absl import logging
+from scipy import sparse
 
 from koch import db
 from koch import pipeline
+from koch import stats
+from koch import table
 from koch import tf_idf
+from koch import vocab
 from koch.proto import document_pb2
 from koch.proto import util
 
@@ -27,6 +31,26 @@ flags.DEFINE_string(
 
 flags.DEFINE_string("label", None, "Metadata field of labels.")
 flags.DEFINE_multi_string("classes", None, "Label classifications.")
+flags.DEFINE_string(
+    "prior_table", None, "Output path to write an in-memory prior table to.")
+
+flags.DEFINE_boolean(
+    "naive_bayes_vectorized", True, "Whether to use sparse matrix operations.")
+flags.DEFINE_string(
+    "naive_bayes_model", None, "Output path to write the trained model to.")
+flags.DEFINE_string(
+    "naive_bayes_predict_model", None,
+    "Input path of a trained model to classify with instead of training.")
+flags.DEFINE_integer(
+    "naive_bayes_batch_size", 1000, "Number of documents to score at once.")
+flags.DEFINE_integer(
+    "naive_bayes_combine_buffer_size", 1000,
+    "Number of documents to combine classifications of in memory, 0 to "
+    "combine each value on disk. Buffered values are whole documents, unlike "
+    "the keywords buffered by --combine_buffer_size.")
+flags.DEFINE_boolean(
+    "naive_bayes_vocab", False,
+    "Whether to train on the vocab ids of words of the input documents.")
 
 
 def Normalize(string):
@@ -41,14 +65,18 @@ def GetValues(string):
         for s in part.split(','))
 
 
+def Classify(value, classes):
+  values = GetValues(value)
+  for c in classes:
+    if c in values:
+      return c
+
+
 def Label(doc, label, classes):
   if label not in doc.metadata:
     return
 
-  values = GetValues(doc.metadata[label])
-  for c in classes:
-    if c in values:
-      return c
+  return Classify(doc.metadata[label], classes)
 
 
 class LabelPipeline(pipeline.Pipeline):
@@ -67,16 +95,29 @@ class LabelPipeline(pipeline.Pipeline):
 
 class PriorPipeline(pipeline.CombiningPipeline):
 
-  def __init__(self, label, classes, reader, rewriter):
-    super(PriorPipeline, self).__init__(reader, rewriter)
-    self.n = tf_idf.GetCorpusSize(reader)
+  def __init__(
+      self, label, classes, reader, rewriter, buffer_size=0, table_path=None,
+      doc_count=None):
+    super(PriorPipeline, self).__init__(reader, rewriter, buffer_size)
+    self.n = (
+        doc_count if doc_count is not None else tf_idf.GetCorpusSize(reader))
     self.classes = classes
     self.label = label
+    self.table_path = table_path
+
+  def run(self):
+    if not self.table_path:
+      return super(PriorPipeline, self).run()
+
+    with self:
+      prior_table = table.from_keywords((k for _, k in self), self.n)
+    prior_table.save(self.table_path)
 
   def pipe(self, key, value):
     doc = value
     label = Label(doc, self.label, self.classes)
-    for word in set(w.text for w in util.IterWords(doc)):
+    vocab, _, _, _ = util.GetTokens(doc)
+    for word in vocab:
       keyword = document_pb2.Keyword()
       keyword.word = word
       keyword.prior[label] = 1
@@ -102,20 +143,40 @@ def GetClassPriors(label, classes, reader):
   out = {c: 0 for c in classes}
   with reader:
     for key, doc in reader:
-      out[Label(doc, label, classes)] += 1
+      c = Label(doc, label, classes)
+      if c:
+        out[c] += 1
   
   return out
 
 
+def GetClassPriorsFromStats(label, classes, corpus):
+  """Returns class priors from the metadata counts of corpus statistics, or
+  None if there were too many values of label to count.
+  """
+  counts = corpus.metadata.get(label, {})
+  if counts is None:
+    return None
+
+  out = {c: 0 for c in classes}
+  for value, count in counts.iteritems():
+    c = Classify(value, classes)
+    if c:
+      out[c] += count
+
+  return out
+
+
 class NaiveBayesPipeline(pipeline.CombiningPipeline):
 
-  def __init__(self, class_priors, reader, rewriter):
-    super(NaiveBayesPipeline, self).__init__(reader, rewriter)
+  def __init__(self, class_priors, reader, rewriter, buffer_size=0):
+    super(NaiveBayesPipeline, self).__init__(reader, rewriter, buffer_size)
     self.label_count = sum(v for k, v in class_priors.iteritems())
     self.class_priors = class_priors
 
   def weight(self, doc, word):
-    return sum(1 for w in util.IterWords(doc) if w.text == word)
+    vocab, counts = util.CountWords(doc)
+    return dict(zip(vocab, counts.tolist())).get(word, 0)
 
   def pipe(self, key, value):
     doc, keyword = value
@@ -145,34 +206,248 @@ class NaiveBayesPipeline(pipeline.CombiningPipeline):
     return old_doc
 
 
+def GetTermCounts(docs, index, grow=False):
+  """Returns a sparse matrix of the counts of each indexed word in each doc.
+
+  Words missing from index are added to it if grow is set and skipped if not.
+  """
+  rows, cols, counts = [], [], []
+  for i, doc in enumerate(docs):
+    vocab, doc_counts = util.CountWords(doc)
+    for word, count in zip(vocab, doc_counts):
+      j = index.get(word)
+      if j is None:
+        if not grow:
+          continue
+        j = index[word] = len(index)
+      rows.append(i)
+      cols.append(j)
+      counts.append(count)
+
+  return sparse.coo_matrix(
+      (np.array(counts, dtype=np.float64), (rows, cols)),
+      shape=(len(docs), len(index))).tocsr()
+
+
+def GetIdTermCounts(docs, words):
+  """Returns a sparse matrix of the counts of each word of a table in each doc.
+
+  The words of each doc are looked up once as an array of ids, skipping words
+  missing from the table.
+  """
+  rows = [np.zeros(0, dtype=np.int64)]
+  cols = [np.zeros(0, dtype=np.int64)]
+  counts = [np.zeros(0, dtype=np.int64)]
+  for i, doc in enumerate(docs):
+    vocab, doc_counts = util.CountWords(doc)
+    ids = words.get_ids(vocab)
+    known = ids >= 0
+    rows.append(np.full(np.count_nonzero(known), i, dtype=np.int64))
+    cols.append(ids[known])
+    counts.append(doc_counts[known])
+
+  return sparse.coo_matrix(
+      (np.concatenate(counts).astype(np.float64),
+       (np.concatenate(rows), np.concatenate(cols))),
+      shape=(len(docs), len(words))).tocsr()
+
+
+class NaiveBayesModel(object):
+  """Scores documents against class log likelihoods of words.
+
+  Scores are those of NaiveBayesPipeline: the log prior of each class plus the
+  log ratio of the smoothed count of class documents containing each word to
+  the number of class documents, weighted by the term counts of the document.
+  """
+
+  def __init__(self, words, classes, log_priors, log_likelihoods):
+    self.words = list(words)
+    self.word_ids = table.Table(self.words)
+    self.classes = list(classes)
+    self.log_priors = log_priors
+    self.log_likelihoods = log_likelihoods
+
+  def score(self, docs):
+    """Returns class scores of docs and how many known words each has."""
+    term_counts = GetIdTermCounts(docs, self.word_ids)
+    scores = term_counts.dot(self.log_likelihoods) + self.log_priors
+    return scores, term_counts.getnnz(axis=1)
+
+  def predict(self, docs):
+    """Returns the likeliest class of each doc, None if no words are known."""
+    scores, known_counts = self.score(docs)
+    best = np.argmax(scores, axis=1) if len(docs) else []
+    return [
+        self.classes[i] if known_count else None
+        for i, known_count in zip(best, known_counts)]
+
+  def save(self, path):
+    columns = {
+      c: self.log_likelihoods[:, i].astype(np.float32)
+      for i, c in enumerate(self.classes)}
+    table.Table(self.words, columns, {
+      "classes": self.classes,
+      "log_priors": list(self.log_priors),
+    }).save(path)
+
+
+def LoadModel(path):
+  model_table = table.load(path)
+  classes = model_table.attributes["classes"]
+  log_likelihoods = np.column_stack([model_table.columns[c] for c in classes])
+  return NaiveBayesModel(
+      model_table.words, classes,
+      np.array(model_table.attributes["log_priors"]), log_likelihoods)
+
+
+def Train(label, classes, reader, batch_size=1000, words=None):
+  """Returns a model trained on the labeled documents of reader.
+
+  Words are indexed by their ids in the table words if given, and otherwise
+  in order of first occurrence. Raises ValueError if a class has no documents,
+  as its likelihoods would be undefined.
+  """
+  index = {}
+  class_counts = np.zeros(len(classes))
+  word_counts = np.zeros((len(words) if words is not None else 0, len(classes)))
+  with reader:
+    for batch in pipeline.chunks(reader, batch_size):
+      docs = [doc for _, doc in batch]
+      labels = [classes.index(Label(doc, label, classes)) for doc in docs]
+      if words is not None:
+        contains = GetIdTermCounts(docs, words)
+      else:
+        contains = GetTermCounts(docs, index, grow=True)
+      contains.data[:] = 1
+      one_hot = sparse.coo_matrix(
+          (np.ones(len(docs)), (range(len(docs)), labels)),
+          shape=(len(docs), len(classes)))
+
+      if words is None:
+        word_counts = np.vstack([word_counts, np.zeros(
+            (len(index) - len(word_counts), len(classes)))])
+      word_counts += contains.T.dot(one_hot).toarray()
+      class_counts += np.asarray(one_hot.sum(axis=0)).ravel()
+
+  if words is not None:
+    # Only words of the training documents are known to the model.
+    seen = word_counts.any(axis=1)
+    words = [word for word, s in zip(words.words, seen) if s]
+    word_counts = word_counts[seen]
+  else:
+    words = sorted(index, key=index.get)
+
+  logging.info("Class priors: %s", dict(zip(classes, class_counts)))
+  missing = [c for c, count in zip(classes, class_counts) if not count]
+  if missing:
+    raise ValueError("No training documents of classes %s" % ", ".join(missing))
+
+  log_priors = np.log(class_counts / class_counts.sum())
+  log_likelihoods = np.log((word_counts + 1) / class_counts)
+
+  return NaiveBayesModel(words, classes, log_priors, log_likelihoods)
+
+
+class BatchNaiveBayesPipeline(pipeline.Pipeline):
+  """Classifies batches of documents with matrix products."""
+
+  def __init__(self, model, reader, writer=None, batch_size=1000):
+    super(BatchNaiveBayesPipeline, self).__init__(reader, writer)
+    self.model = model
+    self.batch_size = batch_size
+
+  def __iter__(self):
+    for batch in pipeline.chunks(self.reader, self.batch_size):
+      docs = [doc for _, doc in batch]
+      scores, known_counts = self.model.score(docs)
+      for doc, doc_scores, known_count in zip(docs, scores, known_counts):
+        if not known_count:
+          continue
+
+        for c, score in zip(self.model.classes, np.asarray(doc_scores).ravel()):
+          doc.classification[c] = score
+        yield str(doc.url), doc
+
+
 def main(argv):
-  doc_reader = db.ProtoDbReader(document_pb2.Document, FLAGS.naive_bayes_input)
+  doc_reader = db.ProtoDbReader(
+      document_pb2.Document, FLAGS.naive_bayes_input, profile="documents")
+
+  if FLAGS.naive_bayes_predict_model:
+    model = LoadModel(FLAGS.naive_bayes_predict_model)
+    naive_bayes_writer = db.ProtoDbWriter(
+        document_pb2.Document, FLAGS.naive_bayes_output, profile="documents",
+        **db.batch_options())
+    BatchNaiveBayesPipeline(
+        model, doc_reader, naive_bayes_writer,
+        FLAGS.naive_bayes_batch_size).run()
+    return
+
+  if not FLAGS.label or not FLAGS.classes:
+    raise app.UsageError("--label and --classes are required for training.")
 
   doc_labels = LabelPipeline(FLAGS.label, FLAGS.classes, doc_reader)
 
-  class_priors = GetClassPriors(FLAGS.label, FLAGS.classes, doc_labels)
+  if FLAGS.naive_bayes_vectorized:
+    words = None
+    if FLAGS.naive_bayes_vocab:
+      words = vocab.load_or_compute(FLAGS.naive_bayes_input, doc_reader)
+    model = Train(
+        FLAGS.label, FLAGS.classes, doc_labels, FLAGS.naive_bayes_batch_size,
+        words)
+    if FLAGS.naive_bayes_model:
+      model.save(FLAGS.naive_bayes_model)
+
+    naive_bayes_writer = db.ProtoDbWriter(
+        document_pb2.Document, FLAGS.naive_bayes_output, profile="documents",
+        **db.batch_options())
+    BatchNaiveBayesPipeline(
+        model, doc_reader, naive_bayes_writer,
+        FLAGS.naive_bayes_batch_size).run()
+    return
+
+  if not FLAGS.tmp_output:
+    raise app.UsageError("--tmp_output is required without vectorization.")
+
+  corpus = stats.load_or_compute(FLAGS.naive_bayes_input, doc_reader)
+  class_priors = GetClassPriorsFromStats(FLAGS.label, FLAGS.classes, corpus)
+  if class_priors is None:
+    class_priors = GetClassPriors(FLAGS.label, FLAGS.classes, doc_reader)
   logging.info("Class priors: %s", class_priors)
 
   prior_rewriter = db.Rewriter(
-      db.ProtoDbReader(document_pb2.Keyword, FLAGS.tmp_output),
-      db.ProtoDbWriter(document_pb2.Keyword, FLAGS.tmp_output))
-  PriorPipeline(FLAGS.label, FLAGS.classes, doc_labels, prior_rewriter).run()
+      db.ProtoDbReader(
+          document_pb2.Keyword, FLAGS.tmp_output, profile="keywords"),
+      db.ProtoDbWriter(
+          document_pb2.Keyword, FLAGS.tmp_output, profile="keywords",
+          **db.batch_options()))
+  PriorPipeline(
+      FLAGS.label, FLAGS.classes, doc_labels, prior_rewriter,
+      FLAGS.combine_buffer_size, FLAGS.prior_table,
+      sum(class_priors.values())).run()
+
+  prior_reader = db.ProtoDbReader(
+      document_pb2.Keyword, FLAGS.tmp_output, profile="keywords")
+  if FLAGS.prior_table:
+    prior_reader = table.KeywordReader(FLAGS.prior_table)
 
   naive_bayes_rewriter = db.Rewriter(
-    db.ProtoDbReader(document_pb2.Document, FLAGS.naive_bayes_output),
-    db.ProtoDbWriter(document_pb2.Document, FLAGS.naive_bayes_output))
+    db.ProtoDbReader(
+        document_pb2.Document, FLAGS.naive_bayes_output, profile="documents"),
+    db.ProtoDbWriter(
+        document_pb2.Document, FLAGS.naive_bayes_output, profile="documents",
+        **db.batch_options()))
   NaiveBayesPipeline(
     class_priors,
     db.JoiningReader(
         tf_idf.TfPipeline(doc_reader),
-        db.ProtoDbReader(document_pb2.Keyword, FLAGS.tmp_output)),
-    naive_bayes_rewriter).run()
+        prior_reader,
+        **db.join_options()),
+    naive_bayes_rewriter,
+    FLAGS.naive_bayes_combine_buffer_size).run()
 
 
 if __name__ == "__main__":
   flags.mark_flag_as_required("naive_bayes_input")
-  flags.mark_flag_as_required("tmp_output")
   flags.mark_flag_as_required("naive_bayes_output")
-  flags.mark_flag_as_required("label")
-  flags.mark_flag_as_required("classes")
   app.run(main)
@@ -0,0 +1,142 @@
+"""Tests for koch.naive_bayes."""
+from __future__ import absolute_import
+
+import os
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from koch import db
+from koch import naive_bayes
+from koch import testing
+from koch.proto import document_pb2
+from koch.proto import util
+
+FLAGS = flags.FLAGS
+
+_LABELS = ["spam", "ham", "spam", "ham"]
+
+
+def get_docs():
+  docs = testing.make_docs(testing.TEXTS + ["alpha omega", "omega psi"])
+  for doc, label in zip(docs, _LABELS):
+    doc.metadata["topic"] = label
+  return docs
+
+
+class NaiveBayesTest(absltest.TestCase):
+
+  def setUp(self):
+    super(NaiveBayesTest, self).setUp()
+    self.tmp = self.create_tempdir().full_path
+    self.input = self.write_docs("parsed")
+
+  def write_docs(self, name, compact=False):
+    path = os.path.join(self.tmp, name)
+    with db.ProtoDbWriter(document_pb2.Document, path) as writer:
+      for doc in get_docs():
+        if compact:
+          util.EncodeWords(doc)
+        writer.write(str(doc.url), doc)
+    return path
+
+  def get_reader(self):
+    return db.ProtoDbReader(document_pb2.Document, self.input)
+
+  def train(self):
+    return naive_bayes.Train(
+        "topic", ["spam", "ham"],
+        naive_bayes.LabelPipeline("topic", ["spam", "ham"], self.get_reader()))
+
+  @flagsaver.flagsaver
+  def classify(self, name, **flag_values):
+    """Runs naive_bayes.main with flag_values, returning the class scores."""
+    FLAGS.naive_bayes_input = self.input
+    FLAGS.naive_bayes_output = os.path.join(self.tmp, name)
+    FLAGS.tmp_output = os.path.join(self.tmp, name + ".tmp")
+    FLAGS.label = "topic"
+    FLAGS.classes = ["spam", "ham"]
+    for flag, value in flag_values.iteritems():
+      setattr(FLAGS, flag, value)
+    naive_bayes.main([])
+
+    reader = db.ProtoDbReader(document_pb2.Document, FLAGS.naive_bayes_output)
+    with reader:
+      return {key: dict(doc.classification) for key, doc in reader}
+
+  def assertScoresAlmostEqual(self, expected, classified):
+    self.assertCountEqual(expected, classified)
+    for key, scores in classified.iteritems():
+      self.assertCountEqual(expected[key], scores)
+      for c, score in scores.iteritems():
+        self.assertAlmostEqual(expected[key][c], score, delta=1e-5)
+
+  def test_vectorized_matches_pipeline(self):
+    self.assertScoresAlmostEqual(
+        self.classify("pipeline", naive_bayes_vectorized=False),
+        self.classify("vectorized"))
+
+  def test_vocab_ids_match_first_occurrence(self):
+    self.assertEqual(
+        self.classify("vectorized"),
+        self.classify("vocab", naive_bayes_vocab=True))
+
+  def test_compact_documents_classify_the_same(self):
+    modes = {
+      "pipeline": {"naive_bayes_vectorized": False},
+      "vectorized": {},
+      "vocab": {"naive_bayes_vocab": True},
+    }
+    expected = {
+        name: self.classify(name, **flag_values)
+        for name, flag_values in modes.iteritems()}
+    self.input = self.write_docs("parsed_compact", compact=True)
+    for name, flag_values in modes.iteritems():
+      self.assertEqual(
+          expected[name], self.classify("compact_" + name, **flag_values), name)
+
+  def test_saved_model_predicts_the_same(self):
+    path = os.path.join(self.tmp, "model")
+    model = self.train()
+    model.save(path)
+    loaded = naive_bayes.LoadModel(path)
+
+    self.assertEqual(model.words, loaded.words)
+    self.assertEqual(model.classes, loaded.classes)
+    docs = get_docs()
+    scores, _ = model.score(docs)
+    loaded_scores, _ = loaded.score(docs)
+    self.assertSequenceAlmostEqual(
+        scores.ravel().tolist(), loaded_scores.ravel().tolist(), delta=1e-5)
+    self.assertEqual(model.predict(docs), loaded.predict(docs))
+    self.assertScoresAlmostEqual(
+        self.classify("vectorized"),
+        self.classify("loaded", naive_bayes_predict_model=path))
+
+  def test_batches_match_predictions(self):
+    model = self.train()
+    docs = get_docs()
+    predicted = {str(doc.url): model.predict([doc])[0] for doc in docs}
+    self.assertIsNone(predicted["http://example.com/5"])
+
+    for batch_size in (1, 2, 4):
+      batches = naive_bayes.BatchNaiveBayesPipeline(
+          model, db.DebugReader([str(doc.url) for doc in docs], docs),
+          batch_size=batch_size)
+      classified = {
+          key: max(doc.classification, key=doc.classification.get)
+          for key, doc in batches}
+      self.assertEqual(
+          {key: c for key, c in predicted.iteritems() if c}, classified)
+
+  def test_rejects_classes_without_documents(self):
+    with self.assertRaisesRegexp(ValueError, "eggs"):
+      naive_bayes.Train(
+          "topic", ["spam", "ham", "eggs"],
+          naive_bayes.LabelPipeline(
+              "topic", ["spam", "ham", "eggs"], self.get_reader()))
+
+
+if __name__ == "__main__":
+  absltest.main()
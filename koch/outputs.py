@@ -0,0 +1,12 @@
+"""Defines the output paths of stages that later stages read as inputs.
+
+Stages import this rather than the stages before them, so that they don't load
+the dependencies of those stages, such as nltk, just for their flags.
+"""
+from __future__ import absolute_import
+
+from absl import flags
+
+flags.DEFINE_string("fetch_output", None, "Output path to write fetched html to.")
+flags.DEFINE_string("extract_output", None, "Output path to write parsed html to.")
+flags.DEFINE_string("parse_output", None, "Output path to write parsed html to.")
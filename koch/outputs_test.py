@@ -0,0 +1,40 @@
+"""Tests that entry points import nltk and pandas only when they use them."""
+from __future__ import absolute_import
+
+import os
+import subprocess
+import sys
+
+from absl.testing import absltest
+
+_ENTRY_POINTS = [
+  "eval", "extract", "fetch", "naive_bayes", "parse", "stream", "text_rank",
+  "tf_idf",
+]
+
+_HEAVY_MODULES = ["nltk", "pandas"]
+
+
+def get_imported(statement):
+  """Returns the heavy modules imported by statement in a fresh interpreter."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  check = "import sys; %s; print(' '.join(m for m in %r if m in sys.modules))"
+  output = subprocess.check_output(
+      [sys.executable, "-c", check % (statement, _HEAVY_MODULES)], env=env)
+  return output.split()
+
+
+class LazyImportTest(absltest.TestCase):
+
+  def test_entry_points_do_not_import_heavy_modules(self):
+    for name in _ENTRY_POINTS:
+      self.assertEqual([], get_imported("import koch.%s" % name), name)
+
+  def test_fetch_imports_pandas_for_dates(self):
+    self.assertEqual(
+        ["pandas"], get_imported(
+            "from koch import fetch; fetch.to_epoch('01/02/2019')"))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -7,27 +7,39 @@ TODO:
 """
 from __future__ import absolute_import
 
-import nltk
 import re2
 
-from nltk.corpus import stopwords
-from nltk.corpus import wordnet
+from backports.functools_lru_cache import lru_cache
 
 from absl import app
 from absl import flags
 
 from koch import db
-from koch import extract
+from koch import outputs
 from koch import pipeline
+from koch import stats
+from koch import vocab
 from koch.proto import document_pb2
+from koch.proto import util
 
-ALL_POS = set([wordnet.NOUN, wordnet.VERB, wordnet.ADJ, wordnet.ADV])
+# The wordnet parts of speech, which would otherwise load the wordnet corpus.
+NOUN = "n"
+VERB = "v"
+ADJ = "a"
+ADV = "r"
+ALL_POS = set([NOUN, VERB, ADJ, ADV])
 
 FLAGS = flags.FLAGS
-flags.DEFINE_string("parse_output", None, "Output path to write parsed html to.")
 flags.DEFINE_boolean("parse_debug", False, "Whether to use the debug writer.")
 
 flags.DEFINE_multi_enum("parse_pos", [], ALL_POS, "Parts of speech to retain")
+flags.DEFINE_boolean(
+    "parse_batched", True, "Whether to tag all blobs of a document at once.")
+flags.DEFINE_integer(
+    "parse_cache_size", 100000, "Number of lemmas and their filters to cache.")
+flags.DEFINE_boolean(
+    "parse_compact", False,
+    "Whether to store the words of documents as compact token arrays.")
 
 
 def add_blob(doc, text, pos):
@@ -47,40 +59,70 @@ def build_blobs(html_element, doc, pos):
 
 def convert_pos(tag):
   if tag.startswith("NN"):
-    return wordnet.NOUN
+    return NOUN
   elif tag.startswith("VB"):
-    return wordnet.VERB
+    return VERB
   elif tag.startswith("JJ"):
-    return wordnet.ADJ
+    return ADJ
   elif tag.startswith("RB"):
-    return wordnet.ADV
-  return wordnet.NOUN
+    return ADV
+  return NOUN
 
 
 class ParsingPipeline(pipeline.Pipeline):
+  """Splits the content html of documents into blobs of lemmatized words.
 
-  def __init__(self, pos, reader, writer=None, debug=False):
+  If batched, the blobs of each document are tagged in one call to a tagger
+  loaded once, and the normalized words of the cache_size most recently seen
+  tokens and parts of speech are cached.
+
+  If compact, the words of each document are stored in its tokens rather than
+  in its blobs.
+
+  nltk takes seconds to import, so it is only imported once a pipeline is made.
+  """
+
+  def __init__(
+      self, pos, reader, writer=None, debug=False, batched=True,
+      cache_size=100000, compact=False):
     super(ParsingPipeline, self).__init__(reader, writer)
+    import nltk
+    from nltk.corpus import stopwords
+    from nltk.tag import perceptron
+
+    self.tokenize = nltk.word_tokenize
+    self.tag = nltk.pos_tag
     self.stopwords = set(stopwords.words("english"))
     self.wordnet = nltk.WordNetLemmatizer()
     self.pos_tags = set(pos) or ALL_POS
     self.debug = debug
+    self.batched = batched
+    self.compact = compact
+    if batched:
+      self.tagger = perceptron.PerceptronTagger()
+      self.get_words = lru_cache(cache_size)(self.get_words)
   
   def pipe(self, key, value):
     doc = value
     for i, elm in enumerate(doc.content_html.elements):
       build_blobs(elm, doc, [i])
 
-    for blob in doc.blobs:
-      tokenized = nltk.word_tokenize(blob.text)
-      pos_tagged = ((t, convert_pos(p)) for t, p in nltk.pos_tag(tokenized))
-      pos_filtered = ((t, p) for t, p in pos_tagged if p in self.pos_tags)
-      lemmatized = (self.wordnet.lemmatize(t, convert_pos(p)) for t, p in pos_filtered)
-      normalized = (t.lower() for s in lemmatized for t in re2.split(r"\W+", s) if t)
-      enumerated = ((i, t) for i, t in enumerate(normalized) if not t.isdigit())
-      filtered = ((i, t) for i, t in enumerated if t not in self.stopwords)
-      for index, text in filtered:
-        blob.words.add(index=index, text=text)
+    if self.batched:
+      self.add_words(doc.blobs)
+    else:
+      for blob in doc.blobs:
+        tokenized = self.tokenize(blob.text)
+        pos_tagged = ((t, convert_pos(p)) for t, p in self.tag(tokenized))
+        pos_filtered = ((t, p) for t, p in pos_tagged if p in self.pos_tags)
+        lemmatized = (self.wordnet.lemmatize(t, convert_pos(p)) for t, p in pos_filtered)
+        normalized = (t.lower() for s in lemmatized for t in re2.split(r"\W+", s) if t)
+        enumerated = ((i, t) for i, t in enumerate(normalized) if not t.isdigit())
+        filtered = ((i, t) for i, t in enumerated if t not in self.stopwords)
+        for index, text in filtered:
+          blob.words.add(index=index, text=text)
+
+    if self.compact:
+      util.EncodeWords(doc)
 
     if not self.debug:
       doc.ClearField("raw_html")
@@ -88,16 +130,50 @@ class ParsingPipeline(pipeline.Pipeline):
       doc.ClearField("content_html")
 
     yield key, doc
+
+  def add_words(self, blobs):
+    tokenized = [self.tokenize(blob.text) for blob in blobs]
+    for blob, pos_tagged in zip(blobs, self.tagger.tag_sents(tokenized)):
+      index = 0
+      for token, tag in pos_tagged:
+        pos = convert_pos(tag)
+        if pos not in self.pos_tags:
+          continue
+
+        for text, keep in self.get_words(token, pos):
+          if keep:
+            blob.words.add(index=index, text=text)
+          index += 1
+
+  def get_words(self, token, pos):
+    """Returns the normalized words of a token, and whether each is kept."""
+    lemma = self.wordnet.lemmatize(token, convert_pos(pos))
+    words = (t.lower() for t in re2.split(r"\W+", lemma) if t)
+    return tuple(
+        (t, not t.isdigit() and t not in self.stopwords) for t in words)
   
 
 def main(argv):
-  reader = db.ProtoDbReader(document_pb2.Document, FLAGS.extract_output)
-  writer = db.ProtoDbWriter(document_pb2.Document, FLAGS.parse_output)
-
-  if not FLAGS.parse_output:
+  reader = db.ProtoDbReader(
+      document_pb2.Document, FLAGS.extract_output, profile="documents",
+      **db.shard_options())
+  writer = db.ProtoDbWriter(
+      document_pb2.Document, FLAGS.parse_output, profile="documents",
+      **db.batch_options())
+
+  if FLAGS.parse_output:
+    stats_path = stats.get_path(FLAGS.parse_output)
+    writer = stats.StatsWriter(writer, stats_path)
+    writer = vocab.VocabWriter(
+        writer, vocab.get_path(FLAGS.parse_output), stats_path)
+  else:
     writer = db.DebugWriter()
 
-  ParsingPipeline(FLAGS.parse_pos, reader, writer, FLAGS.parse_debug).run()
+  parsing = ParsingPipeline(
+      FLAGS.parse_pos, reader, writer, FLAGS.parse_debug, FLAGS.parse_batched,
+      FLAGS.parse_cache_size, FLAGS.parse_compact)
+  parsing.executor = pipeline.default_executor()
+  parsing.run()
  
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+"""Tests for koch.parse."""
+from __future__ import absolute_import
+
+from absl.testing import absltest
+
+from koch import parse
+from koch.proto import document_pb2
+
+_HTML = [
+  ("p", "The cats were running quickly across 3 gardens.", " And then"),
+  ("div", "Dogs barked; birds sang, and nobody slept in 2019!", ""),
+  ("p", "The cats were running again.", " It's the end"),
+]
+
+
+def make_doc():
+  doc = document_pb2.Document(url="http://example.com/0")
+  element = doc.content_html.elements.add(tag="body", text="Short intro")
+  for tag, text, tail in _HTML:
+    element.children.add(tag=tag, text=text, tail=tail)
+  return doc
+
+
+def parse_doc(pos=(), **kwargs):
+  parsing = parse.ParsingPipeline(list(pos), None, **kwargs)
+  (_, doc), = parsing.pipe("http://example.com/0", make_doc())
+  return parsing, doc
+
+
+class ParsingPipelineTest(absltest.TestCase):
+
+  def test_batched_tagging_matches_unbatched(self):
+    for pos in ([], [parse.NOUN], [parse.VERB, parse.ADJ]):
+      _, expected = parse_doc(pos, batched=False)
+      _, batched = parse_doc(pos, batched=True)
+      self.assertEqual(expected.blobs, batched.blobs)
+
+    self.assertNotEmpty(sum((list(b.words) for b in expected.blobs), []))
+
+  def test_caches_words(self):
+    parsing, _ = parse_doc()
+    # Repeated tokens, like "cats" and "running", are only lemmatized once.
+    self.assertGreater(parsing.get_words.cache_info().hits, 0)
+
+  def test_batched_by_default(self):
+    parsing = parse.ParsingPipeline([], None)
+    self.assertTrue(parsing.batched)
+
+
+if __name__ == "__main__":
+  absltest.main()
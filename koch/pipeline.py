@@ -1,19 +1,278 @@
 """Abstract pipeline representing processing step.
 
 TODO:
- - enable writing from nested pipelines.
  - just use apache beam.
 """
 from __future__ import absolute_import
 
+import collections
+import itertools
+import multiprocessing
+import Queue
+import six
+import sys
+import threading
+import time
+
+from absl import flags
+from absl import logging
+
 from koch import db
 
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+    "pipeline_processes", 1, "Number of processes to run pipelines with.")
+flags.DEFINE_integer(
+    "pipeline_chunk_size", 64, "Number of items sent to a process at once.")
+flags.DEFINE_integer(
+    "pipeline_queue_size", None, "Maximum number of chunks in flight.")
+flags.DEFINE_boolean(
+    "pipeline_ordered", True, "Whether to keep outputs in input order.")
+flags.DEFINE_float(
+    "pipeline_log_interval", 60.0, "Seconds between logs of pipeline meters.")
+
+_DONE = object()
+_ERROR = object()
+_RESULT = object()
+
+
+def _put(queue, item, stop):
+  while not stop.is_set():
+    try:
+      queue.put(item, timeout=0.1)
+      return True
+    except Queue.Full:
+      continue
+  return False
+
+
+def _get(queue, stop):
+  while not stop.is_set():
+    try:
+      return queue.get(timeout=0.1)
+    except Queue.Empty:
+      continue
+  return _DONE
+
+
+class Meter(object):
+  """Measures the throughput of an executor and the depth of its queue.
+
+  Measurements are logged every interval seconds, and once more when the
+  executor finishes.
+  """
+
+  def __init__(self, name, interval=None):
+    self.name = name
+    self.interval = interval or FLAGS.pipeline_log_interval
+    self.count = 0
+    self.samples = 0
+    self.total_depth = 0
+    self.max_depth = 0
+    self.start = None
+    self.logged = None
+
+  def update(self, count, depth=0):
+    now = time.time()
+    if self.start is None:
+      self.start = self.logged = now
+
+    self.count += count
+    self.samples += 1
+    self.total_depth += depth
+    self.max_depth = max(self.max_depth, depth)
+    if now - self.logged >= self.interval:
+      self.log(now)
+
+  def log(self, now=None):
+    if self.start is None:
+      return
+
+    now = now or time.time()
+    self.logged = now
+    elapsed = now - self.start
+    logging.info(
+        "%s: %d items in %.1fs (%.1f items/s), queue depth %.1f mean %d max",
+        self.name, self.count, elapsed, self.count / max(elapsed, 1e-9),
+        float(self.total_depth) / max(self.samples, 1), self.max_depth)
+
+
+class SerialExecutor(object):
+
+  def __init__(self, meter=None):
+    self.meter = meter
+
+  def map(self, fn, items):
+    try:
+      for item in items:
+        for out in fn(*item):
+          if self.meter:
+            self.meter.update(1)
+          yield out
+    finally:
+      if self.meter:
+        self.meter.log()
+
+
+class ThreadExecutor(object):
+  """Maps a function over items using a pool of threads.
+
+  At most queue_size items are buffered on either side of the pool, so memory
+  stays flat however large the input is. Outputs are yielded in the order they
+  complete, and the first exception raised by a worker is reraised. If meter
+  is set, it measures outputs and the depth of the output queue.
+  """
+
+  def __init__(self, workers, queue_size=None, meter=None):
+    self.workers = workers
+    self.queue_size = queue_size or 2 * workers
+    self.meter = meter
+
+  def map(self, fn, items):
+    inputs = Queue.Queue(self.queue_size)
+    outputs = Queue.Queue(self.queue_size)
+    stop = threading.Event()
+
+    def feed():
+      try:
+        for item in items:
+          if not _put(inputs, item, stop):
+            return
+      except Exception:
+        _put(outputs, (_ERROR, sys.exc_info()), stop)
+      finally:
+        for _ in range(self.workers):
+          _put(inputs, _DONE, stop)
+
+    def work():
+      for item in iter(lambda: _get(inputs, stop), _DONE):
+        try:
+          for out in fn(*item):
+            if not _put(outputs, (_RESULT, out), stop):
+              return
+        except Exception:
+          _put(outputs, (_ERROR, sys.exc_info()), stop)
+      _put(outputs, (_DONE, None), stop)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(self.workers))
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+
+    try:
+      done = 0
+      while done < self.workers:
+        kind, out = _get(outputs, stop)
+        if kind is _DONE:
+          done += 1
+        elif kind is _ERROR:
+          six.reraise(*out)
+        else:
+          if self.meter:
+            self.meter.update(1, outputs.qsize())
+          yield out
+    finally:
+      stop.set()
+      if self.meter:
+        self.meter.log()
+
+
+_worker_fn = None
+
+
+def _init_worker(fn):
+  global _worker_fn
+  _worker_fn = fn
+
+
+def _map_chunk(chunk):
+  return [out for item in chunk for out in _worker_fn(*item)]
+
+
+def chunks(items, size):
+  it = iter(items)
+  chunk = list(itertools.islice(it, size))
+  while chunk:
+    yield chunk
+    chunk = list(itertools.islice(it, size))
+
+
+class ProcessExecutor(object):
+  """Maps a function over items using a pool of forked processes.
+
+  Items are pickled to the workers in chunks of chunk_size, and the reader is
+  only advanced while fewer than queue_size chunks are in flight. Outputs are
+  yielded in input order unless ordered is False, in which case each chunk is
+  yielded as soon as it completes. If meter is set, it measures outputs and
+  the number of chunks in flight.
+  """
+
+  def __init__(
+      self, processes, chunk_size=64, queue_size=None, ordered=True,
+      meter=None):
+    self.processes = processes
+    self.chunk_size = chunk_size
+    self.queue_size = queue_size or 2 * processes
+    self.ordered = ordered
+    self.meter = meter
+
+  def map(self, fn, items):
+    pool = multiprocessing.Pool(self.processes, _init_worker, (fn,))
+    try:
+      pending = collections.deque()
+      for chunk in chunks(items, self.chunk_size):
+        pending.append(pool.apply_async(_map_chunk, (chunk,)))
+        while len(pending) >= self.queue_size:
+          for out in self.pop(pending):
+            yield out
+
+      while pending:
+        for out in self.pop(pending):
+          yield out
+      pool.close()
+    finally:
+      pool.terminate()
+      pool.join()
+      if self.meter:
+        self.meter.log()
+
+  def pop(self, pending):
+    depth = len(pending)
+    outs = self.wait(pending)
+    if self.meter:
+      self.meter.update(len(outs), depth)
+    return outs
+
+  def wait(self, pending):
+    if self.ordered:
+      return pending.popleft().get()
+
+    while True:
+      for result in pending:
+        if result.ready():
+          pending.remove(result)
+          return result.get()
+      pending[0].wait(0.01)
+
+
+def default_executor():
+  """Returns the executor set by flags."""
+  if FLAGS.pipeline_processes > 1:
+    return ProcessExecutor(
+        FLAGS.pipeline_processes,
+        FLAGS.pipeline_chunk_size,
+        FLAGS.pipeline_queue_size,
+        FLAGS.pipeline_ordered)
+  return SerialExecutor()
+
 
 class Pipeline(object):
   
   def __init__(self, reader, writer=None):
     self.reader = reader
     self.writer = writer or db.FakeWriter()
+    self.executor = SerialExecutor()
 
   def __enter__(self):
     self.reader.__enter__()
@@ -25,9 +284,12 @@ class Pipeline(object):
     self.reader.__exit__(*args)
 
   def __iter__(self):
-    for k, v in self.reader:
-      for key, val in self.pipe(k, v):
-        yield key, val
+    for key, val in self.execute():
+      yield key, val
+
+  def execute(self):
+    """Yields the outputs of pipe over every item of the reader."""
+    return self.executor.map(self.pipe, self.reader)
       
   def run(self):
     with self:
@@ -38,21 +300,82 @@ class Pipeline(object):
     return key, value
 
 
+class TeePipeline(Pipeline):
+  """Passes items through unchanged, writing them to writer as they pass.
+
+  Unlike other pipelines this writes when iterated, so it can persist the
+  outputs of a pipeline nested as the reader of another.
+  """
+
+  def __iter__(self):
+    for key, val in self.execute():
+      self.writer.write(key, val)
+      yield key, val
+
+  def run(self):
+    with self:
+      for out in self:
+        pass
+
+  def pipe(self, key, value):
+    yield key, value
+
+
+class ChainedPipeline(Pipeline):
+  """Pipes every item through the pipe of each of stages in turn.
+
+  The readers and writers of stages are unused, so a single executor runs all
+  of them on each item without reading or writing anything in between.
+  """
+
+  def __init__(self, stages, reader, writer=None):
+    super(ChainedPipeline, self).__init__(reader, writer)
+    self.stages = stages
+
+  def pipe(self, key, value):
+    items = [(key, value)]
+    for stage in self.stages:
+      items = [out for item in items for out in stage.pipe(*item)]
+    return items
+
+
 class CombiningPipeline(Pipeline):
+  """Combines piped values into the values of a rewriter by key.
+
+  If buffer_size is set, values are combined in memory and written back to the
+  rewriter in sorted runs once buffer_size keys are buffered, so each key is
+  read and written once per run it appears in rather than once per value. Keys
+  seen throughout the input appear in about one run per buffer_size distinct
+  keys, so buffer_size should be at least the number of distinct keys for each
+  key to be read and written once.
+  """
 
-  def __init__(self, reader, rewriter):
+  def __init__(self, reader, rewriter, buffer_size=0):
     super(CombiningPipeline, self).__init__(reader, rewriter)
+    self.buffer_size = buffer_size
 
   def __iter__(self):
-    for k, v in self.reader:
-      for piped in self.pipe(k, v):
-        key, value = piped
+    buffer = {}
+    for key, value in self.execute():
+      if not self.buffer_size:
         old_value = self.writer.get(key)
         new_value = self.combine(value, old_value)
         self.writer.write(key, new_value)
+        continue
 
+      old_value = buffer[key] if key in buffer else self.writer.get(key)
+      buffer[key] = self.combine(value, old_value)
+      if len(buffer) >= self.buffer_size:
+        self.spill(buffer)
+
+    self.spill(buffer)
     for out in self.writer:
       yield out
+
+  def spill(self, buffer):
+    for key in sorted(buffer):
+      self.writer.write(key, buffer[key])
+    buffer.clear()
       
   def run(self):
     with self:
@@ -0,0 +1,174 @@
+"""Tests for koch.pipeline."""
+from __future__ import absolute_import
+
+import os
+import time
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from koch import db
+from koch import pipeline
+from koch.proto import document_pb2
+
+FLAGS = flags.FLAGS
+
+def square(key, value):
+  # Later items finish first, so completion order differs from input order.
+  time.sleep(0.01 * (5 - key % 5))
+  yield key, value * value
+
+
+def fail(key, value):
+  if key == 3:
+    raise ValueError("failed %d" % key)
+  yield key, value
+
+
+def get_items(count=20):
+  return [(i, i) for i in range(count)]
+
+
+def get_squares(count=20):
+  return [(i, i * i) for i in range(count)]
+
+
+class ExecutorTest(absltest.TestCase):
+
+  def test_serial_executor_keeps_order(self):
+    outs = list(pipeline.SerialExecutor().map(square, get_items()))
+    self.assertEqual(get_squares(), outs)
+
+  def test_thread_executor_yields_every_output(self):
+    executor = pipeline.ThreadExecutor(4, queue_size=2)
+    outs = list(executor.map(square, get_items()))
+    self.assertCountEqual(get_squares(), outs)
+
+  def test_thread_executor_reraises(self):
+    executor = pipeline.ThreadExecutor(4)
+    with self.assertRaisesRegexp(ValueError, "failed 3"):
+      list(executor.map(fail, get_items()))
+
+  def test_process_executor_keeps_order(self):
+    executor = pipeline.ProcessExecutor(3, chunk_size=2, queue_size=2)
+    outs = list(executor.map(square, get_items()))
+    self.assertEqual(get_squares(), outs)
+
+  def test_process_executor_unordered_yields_every_output(self):
+    executor = pipeline.ProcessExecutor(
+        3, chunk_size=2, queue_size=2, ordered=False)
+    outs = list(executor.map(square, get_items()))
+    self.assertCountEqual(get_squares(), outs)
+
+  def test_process_executor_reraises(self):
+    executor = pipeline.ProcessExecutor(2, chunk_size=2)
+    with self.assertRaisesRegexp(ValueError, "failed 3"):
+      list(executor.map(fail, get_items()))
+
+  def test_chunks(self):
+    self.assertEqual(
+        [[0, 1, 2], [3, 4, 5], [6]], list(pipeline.chunks(range(7), 3)))
+
+  def test_executors_meter_outputs(self):
+    for executor in (
+        pipeline.SerialExecutor(pipeline.Meter("serial")),
+        pipeline.ThreadExecutor(4, meter=pipeline.Meter("thread")),
+        pipeline.ProcessExecutor(
+            3, chunk_size=2, queue_size=2, meter=pipeline.Meter("process"))):
+      list(executor.map(square, get_items()))
+      self.assertEqual(20, executor.meter.count, executor.meter.name)
+
+    # Chunks in flight are measured before each is yielded.
+    self.assertEqual(10, executor.meter.samples)
+    self.assertEqual(2, executor.meter.max_depth)
+
+  @flagsaver.flagsaver
+  def test_default_executor_is_set_by_flags(self):
+    self.assertIsInstance(pipeline.default_executor(), pipeline.SerialExecutor)
+
+    FLAGS.pipeline_processes = 3
+    FLAGS.pipeline_chunk_size = 5
+    FLAGS.pipeline_queue_size = 7
+    FLAGS.pipeline_ordered = False
+    executor = pipeline.default_executor()
+    self.assertIsInstance(executor, pipeline.ProcessExecutor)
+    self.assertEqual(
+        (3, 5, 7, False),
+        (executor.processes, executor.chunk_size, executor.queue_size,
+         executor.ordered))
+
+
+class MeterTest(absltest.TestCase):
+
+  def test_measures_throughput_and_queue_depth(self):
+    meter = pipeline.Meter("test", interval=3600.0)
+    meter.log()
+    self.assertIsNone(meter.start)
+
+    meter.update(2, 4)
+    meter.update(3, 0)
+    meter.update(1, 2)
+    self.assertEqual(6, meter.count)
+    self.assertEqual(3, meter.samples)
+    self.assertEqual(6, meter.total_depth)
+    self.assertEqual(4, meter.max_depth)
+    self.assertEqual(meter.start, meter.logged)
+
+  def test_logs_every_interval(self):
+    meter = pipeline.Meter("test", interval=0.01)
+    meter.update(1)
+    start = meter.logged
+    time.sleep(0.02)
+    meter.update(1)
+    self.assertGreater(meter.logged, start)
+
+
+class CountingPipeline(pipeline.CombiningPipeline):
+
+  def pipe(self, key, value):
+    for word in value.split():
+      yield word, document_pb2.Keyword(word=word, doc_count=1)
+
+  def combine(self, value, old_value):
+    if not old_value.word:
+      return value
+
+    old_value.doc_count += value.doc_count
+    return old_value
+
+
+class CombiningPipelineTest(absltest.TestCase):
+
+  texts = ["a b c", "b c d", "c d e", "a a f", "g", "f e d c b a"]
+
+  def count(self, buffer_size, batch_size=0):
+    path = os.path.join(self.create_tempdir().full_path, "counts")
+    rewriter = db.Rewriter(
+        db.ProtoDbReader(document_pb2.Keyword, path),
+        db.ProtoDbWriter(document_pb2.Keyword, path, batch_size=batch_size))
+    counting = CountingPipeline(
+        db.DebugReader(range(len(self.texts)), self.texts), rewriter,
+        buffer_size)
+    with counting:
+      return [(key, keyword.doc_count) for key, keyword in counting]
+
+  def test_counts_on_disk(self):
+    self.assertEqual([
+      ("a", 4), ("b", 3), ("c", 4), ("d", 3), ("e", 2), ("f", 2), ("g", 1),
+    ], self.count(0))
+
+  def test_spilled_counts_match_on_disk(self):
+    expected = self.count(0)
+    for buffer_size in (1, 2, 3, 7, 100):
+      self.assertEqual(expected, self.count(buffer_size), buffer_size)
+
+  def test_spilled_counts_match_with_batched_writes(self):
+    expected = self.count(0)
+    for buffer_size in (0, 2, 3):
+      self.assertEqual(
+          expected, self.count(buffer_size, batch_size=2), buffer_size)
+
+
+if __name__ == "__main__":
+  absltest.main()
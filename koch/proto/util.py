@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import numpy as np
+
 from koch.proto import document_pb2
 
 
@@ -8,6 +10,59 @@ def GetText(document):
 
 
 def IterWords(document):
+  if document.HasField("tokens"):
+    tokens = document.tokens
+    for i, index in zip(tokens.ids, tokens.indices):
+      yield document_pb2.Word(text=tokens.vocab[i], index=index)
+    return
+
   for blob in document.blobs:
     for word in blob.words:
       yield word
+
+
+def GetTokens(document):
+  """Returns the vocab of document and arrays of the fields of its tokens.
+
+  The arrays hold the vocab id, blob and index in the blob of each token, in
+  order, whether the words of document are stored compactly or in its blobs.
+  """
+  if document.HasField("tokens"):
+    tokens = document.tokens
+    return (
+        list(tokens.vocab), np.array(tokens.ids, dtype=np.int32),
+        np.array(tokens.blobs, dtype=np.int32),
+        np.array(tokens.indices, dtype=np.int32))
+
+  ids = {}
+  vocab, tokens = [], []
+  for i, blob in enumerate(document.blobs):
+    for word in blob.words:
+      j = ids.get(word.text)
+      if j is None:
+        j = ids[word.text] = len(vocab)
+        vocab.append(word.text)
+      tokens.append((j, i, word.index))
+
+  tokens = np.array(tokens, dtype=np.int32).reshape(-1, 3)
+  return vocab, tokens[:, 0], tokens[:, 1], tokens[:, 2]
+
+
+def CountWords(document):
+  """Returns the vocab of document and the term count of each word in it."""
+  vocab, ids, _, _ = GetTokens(document)
+  return vocab, np.bincount(ids, minlength=len(vocab))
+
+
+def EncodeWords(document):
+  """Moves the words of the blobs of document into its compact tokens."""
+  vocab, ids, blobs, indices = GetTokens(document)
+  for blob in document.blobs:
+    blob.ClearField("words")
+
+  document.ClearField("tokens")
+  document.tokens.vocab.extend(vocab)
+  document.tokens.ids.extend(ids.tolist())
+  document.tokens.blobs.extend(blobs.tolist())
+  document.tokens.indices.extend(indices.tolist())
+  document.tokens.SetInParent()
@@ -0,0 +1,68 @@
+"""Tests for koch.proto.util."""
+from __future__ import absolute_import
+
+from absl.testing import absltest
+
+from koch import testing
+from koch.proto import document_pb2
+from koch.proto import util
+
+
+def get_fields(doc):
+  vocab, ids, blobs, indices = util.GetTokens(doc)
+  return vocab, ids.tolist(), blobs.tolist(), indices.tolist()
+
+
+def get_words(doc):
+  return [(word.text, word.index) for word in util.IterWords(doc)]
+
+
+class EncodeWordsTest(absltest.TestCase):
+
+  def test_round_trips_tokens(self):
+    for seed in range(5):
+      doc = testing.make_random_doc(seed)
+      compact = testing.copy(doc)
+      util.EncodeWords(compact)
+
+      self.assertTrue(compact.HasField("tokens"))
+      self.assertFalse(any(blob.words for blob in compact.blobs))
+      self.assertEqual(get_fields(doc), get_fields(compact))
+      self.assertEqual(get_words(doc), get_words(compact))
+      self.assertEqual(util.GetText(doc), util.GetText(compact))
+
+      vocab, counts = util.CountWords(doc)
+      compact_vocab, compact_counts = util.CountWords(compact)
+      self.assertEqual(vocab, compact_vocab)
+      self.assertEqual(counts.tolist(), compact_counts.tolist())
+
+      reparsed = document_pb2.Document.FromString(compact.SerializeToString())
+      self.assertEqual(get_fields(doc), get_fields(reparsed))
+
+  def test_encoding_twice_changes_nothing(self):
+    doc = testing.make_doc("http://example.com", "a b a", "c a")
+    util.EncodeWords(doc)
+    encoded = testing.copy(doc)
+    util.EncodeWords(doc)
+    self.assertEqual(encoded, doc)
+
+  def test_gets_tokens_in_order(self):
+    doc = testing.make_doc("http://example.com", "a b a", "", "c a")
+    self.assertEqual(
+        (["a", "b", "c"], [0, 1, 0, 2, 0], [0, 0, 0, 2, 2], [0, 1, 2, 0, 1]),
+        get_fields(doc))
+    util.EncodeWords(doc)
+    self.assertEqual(
+        (["a", "b", "c"], [0, 1, 0, 2, 0], [0, 0, 0, 2, 2], [0, 1, 2, 0, 1]),
+        get_fields(doc))
+
+  def test_encodes_documents_without_words(self):
+    doc = testing.make_doc("http://example.com")
+    util.EncodeWords(doc)
+    self.assertTrue(doc.HasField("tokens"))
+    self.assertEqual(([], [], [], []), get_fields(doc))
+    self.assertEqual(0, len(util.CountWords(doc)[1]))
+
+
+if __name__ == "__main__":
+  absltest.main()
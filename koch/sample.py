@@ -51,7 +51,7 @@ class SamplingPipeline(pipeline.Pipeline):
 def main(argv):
   random.seed(0)
   reader = db.DbReader(FLAGS.sample_input)
-  writer = db.DbWriter(FLAGS.sample_output)
+  writer = db.DbWriter(FLAGS.sample_output, **db.batch_options())
 
   if FLAGS.sample_input_csv:
     reader = db.CsvReader(
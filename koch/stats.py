@@ -0,0 +1,131 @@
+"""Records corpus statistics alongside document databases."""
+from __future__ import absolute_import
+
+import json
+import os
+
+from absl import logging
+
+from koch import db
+
+
+def get_path(path):
+  """Returns the path of the statistics of the database at path."""
+  return path.rstrip("/") + ".stats.json"
+
+
+# Metadata fields with more distinct values than this, like titles or dates,
+# are not counted, so the statistics stay small enough to load at once.
+MAX_METADATA_VALUES = 1000
+
+
+class CorpusStats(object):
+  """Counts documents and metadata values of a corpus.
+
+  The words of a corpus are counted by its vocab.CorpusVocab instead, which
+  records their number as vocab_size when written with a vocab.VocabWriter.
+  Fields with over max_values distinct values have None for their counts.
+  """
+
+  def __init__(
+      self, doc_count=0, metadata=None, vocab_size=None,
+      max_values=MAX_METADATA_VALUES):
+    self.doc_count = doc_count
+    self.metadata = metadata or {}
+    self.vocab_size = vocab_size
+    self.max_values = max_values
+
+  def add(self, doc):
+    self.doc_count += 1
+    for field, value in doc.metadata.iteritems():
+      counts = self.metadata.setdefault(field, {})
+      if counts is None:
+        continue
+
+      counts[value] = counts.get(value, 0) + 1
+      if len(counts) > self.max_values:
+        logging.info("Not counting values of metadata field %s", field)
+        self.metadata[field] = None
+
+  def save(self, path):
+    with open(path, "w") as f:
+      json.dump({
+        "doc_count": self.doc_count,
+        "vocab_size": self.vocab_size,
+        "metadata": self.metadata,
+      }, f)
+
+
+def load(path):
+  """Returns the statistics saved at path, or None if there are none."""
+  if not os.path.exists(path):
+    return None
+
+  with open(path) as f:
+    saved = json.load(f)
+  return CorpusStats(
+      saved["doc_count"], saved.get("metadata"), saved.get("vocab_size"))
+
+
+def compute(reader, corpus_type=CorpusStats):
+  """Returns a corpus_type of every document of reader."""
+  corpus = corpus_type()
+  with reader:
+    for _, doc in reader:
+      corpus.add(doc)
+  return corpus
+
+
+def load_or_compute_corpus(path, reader, corpus_type, load_fn):
+  """Returns the corpus saved at path by load_fn, saving it first if needed.
+
+  corpus_type is computed over reader and saved when nothing is saved at path.
+  """
+  if not os.path.exists(path):
+    logging.info(
+        "Nothing saved at %s, computing %s", path, corpus_type.__name__)
+    compute(reader, corpus_type).save(path)
+  return load_fn(path)
+
+
+def load_or_compute(path, reader):
+  """Returns the statistics of the database at path, scanning it if needed."""
+  return load_or_compute_corpus(get_path(path), reader, CorpusStats, load)
+
+
+class CorpusWriter(db.Writer):
+  """Wraps a writer of documents, saving a corpus_type of them on exit."""
+
+  corpus_type = None
+
+  def __init__(self, writer, path):
+    super(CorpusWriter, self).__init__(None)
+    self.writer = writer
+    self.path = path
+    self.corpus = self.corpus_type()
+
+  def __enter__(self):
+    self.writer.__enter__()
+    self.corpus = self.corpus_type()
+    return self
+
+  def __exit__(self, *args):
+    self.writer.__exit__(*args)
+    if not args or args[0] is None:
+      self.corpus.save(self.path)
+
+  def write(self, key, value):
+    self.corpus.add(value)
+    self.writer.write(key, value)
+
+  def flush(self):
+    self.writer.flush()
+
+  def peek(self, key):
+    return self.writer.peek(key)
+
+
+class StatsWriter(CorpusWriter):
+  """Wraps a writer of documents, saving their statistics on exit."""
+
+  corpus_type = CorpusStats
@@ -0,0 +1,105 @@
+"""Tests for koch.stats and koch.vocab."""
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+
+from absl.testing import absltest
+
+from koch import db
+from koch import stats
+from koch import testing
+from koch import vocab
+from koch.proto import document_pb2
+
+_TEXTS = ["alpha beta alpha", "beta gamma", "gamma"]
+
+
+def get_docs():
+  docs = testing.make_docs(_TEXTS)
+  for i, doc in enumerate(docs):
+    doc.metadata["source"] = "a" if i else "b"
+  return docs
+
+
+class CorpusTest(absltest.TestCase):
+
+  def setUp(self):
+    super(CorpusTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "parsed")
+
+  def write_docs(self):
+    writer = db.ProtoDbWriter(document_pb2.Document, self.path)
+    writer = stats.StatsWriter(writer, stats.get_path(self.path))
+    writer = vocab.VocabWriter(
+        writer, vocab.get_path(self.path), stats.get_path(self.path))
+    with writer:
+      for doc in get_docs():
+        writer.write(str(doc.url), doc)
+
+  def get_reader(self):
+    return db.ProtoDbReader(document_pb2.Document, self.path)
+
+  def assertCorpus(self, corpus, words):
+    self.assertEqual(3, corpus.doc_count)
+    self.assertEqual({"source": {"a": 2, "b": 1}}, corpus.metadata)
+    self.assertEqual([u"alpha", u"beta", u"gamma"], words.words)
+    self.assertEqual([1, 2, 2], words.columns["doc_count"].tolist())
+    self.assertEqual(3, words.attributes["total_doc_count"])
+
+  def test_writers_save_corpus(self):
+    self.write_docs()
+    self.assertCorpus(
+        stats.load(stats.get_path(self.path)),
+        vocab.load_or_compute(self.path, None))
+
+  def test_vocab_ids_follow_word_order(self):
+    self.write_docs()
+    words = vocab.load_or_compute(self.path, None)
+    self.assertEqual(
+        [2, 0, -1], words.get_ids([u"gamma", u"alpha", u"missing"]).tolist())
+
+  def test_vocab_writer_records_vocab_size(self):
+    self.write_docs()
+    self.assertEqual(3, stats.load(stats.get_path(self.path)).vocab_size)
+
+  def test_stops_counting_fields_with_many_values(self):
+    corpus = stats.CorpusStats(max_values=2)
+    for doc in get_docs():
+      doc.metadata["title"] = doc.url
+      corpus.add(doc)
+    corpus.save(stats.get_path(self.path))
+
+    loaded = stats.load(stats.get_path(self.path))
+    self.assertEqual(
+        {"source": {"a": 2, "b": 1}, "title": None}, loaded.metadata)
+
+  def test_computes_missing_corpus(self):
+    self.write_docs()
+    os.remove(stats.get_path(self.path))
+    shutil.rmtree(vocab.get_path(self.path))
+
+    self.assertCorpus(
+        stats.load_or_compute(self.path, self.get_reader()),
+        vocab.load_or_compute(self.path, self.get_reader()))
+    self.assertTrue(os.path.exists(stats.get_path(self.path)))
+    self.assertTrue(os.path.exists(vocab.get_path(self.path)))
+
+  def test_loads_stats_with_vocab_size(self):
+    with open(stats.get_path(self.path), "w") as f:
+      json.dump({"doc_count": 3, "vocab_size": 3, "metadata": {}}, f)
+    corpus = stats.load(stats.get_path(self.path))
+    self.assertEqual(3, corpus.doc_count)
+    self.assertEqual(3, corpus.vocab_size)
+
+  def test_writers_do_not_save_on_error(self):
+    writer = stats.StatsWriter(db.FakeWriter(), stats.get_path(self.path))
+    with self.assertRaises(ValueError):
+      with writer:
+        raise ValueError()
+    self.assertFalse(os.path.exists(stats.get_path(self.path)))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,132 @@
+"""Streams documents from fetching to keyword scoring in a single process.
+
+Every stage runs on each document in memory as it arrives, so documents are
+only serialized when written to the output, or to the usual output of the
+stages listed in --stream_persist.
+"""
+from __future__ import absolute_import
+
+from absl import app
+from absl import flags
+
+from koch import db
+from koch import extract
+from koch import fetch
+from koch import parse
+from koch import pipeline
+from koch import stats
+from koch import table
+from koch import text_rank
+from koch import tf_idf
+from koch import vocab
+from koch.proto import document_pb2
+
+_SCORES = ["text_rank", "tf_idf"]
+_STAGES = ["fetch", "extract", "parse"] + _SCORES
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    "stream_output", None, "Output path to write scored documents to.")
+flags.DEFINE_multi_enum(
+    "stream_persist", [], _STAGES,
+    "Stages to also write the outputs of, to their usual output paths.")
+flags.DEFINE_multi_enum(
+    "stream_score", ["text_rank"], _SCORES,
+    "Keyword scores to compute, tf-idf using the idf table.")
+
+
+def get_outputs():
+  return {
+    "fetch": FLAGS.fetch_output,
+    "extract": FLAGS.extract_output,
+    "parse": FLAGS.parse_output,
+    "text_rank": FLAGS.text_rank_output,
+    "tf_idf": FLAGS.tf_idf_output,
+  }
+
+
+def get_writer(stage):
+  """Returns the writer persisting the outputs of stage, if requested."""
+  if stage not in FLAGS.stream_persist:
+    return None
+
+  path = get_outputs()[stage]
+  if not path:
+    raise app.UsageError("Output path of %s is required to persist it." % stage)
+
+  writer = db.ProtoDbWriter(
+      document_pb2.Document, path, profile="documents", **db.batch_options())
+  if stage == "parse":
+    writer = stats.StatsWriter(writer, stats.get_path(path))
+    writer = vocab.VocabWriter(
+        writer, vocab.get_path(path), stats.get_path(path))
+  return writer
+
+
+def get_stages(idf_reader=None):
+  """Returns the names and pipelines of the stages after fetching."""
+  stages = [
+    ("extract", extract.ExtractionPipeline(None)),
+    ("parse", parse.ParsingPipeline(
+        FLAGS.parse_pos, None, batched=FLAGS.parse_batched,
+        cache_size=FLAGS.parse_cache_size, compact=FLAGS.parse_compact)),
+  ]
+
+  if "text_rank" in FLAGS.stream_score:
+    stages.append(("text_rank", text_rank.TextRankPipeline(
+        None, None, FLAGS.text_rank_vectorized)))
+
+  if "tf_idf" in FLAGS.stream_score:
+    stages.append(("tf_idf", tf_idf.TableTfIdfPipeline(
+        FLAGS.min_df, idf_reader, None)))
+
+  return stages
+
+
+def chain(reader, stages):
+  """Chains stages after reader, split where their outputs are persisted."""
+  pending = []
+  for name, stage in stages:
+    pending.append(stage)
+    writer = get_writer(name)
+    if writer:
+      reader = pipeline.ChainedPipeline(pending, reader)
+      reader.executor = pipeline.default_executor()
+      reader = pipeline.TeePipeline(reader, writer)
+      pending = []
+
+  if pending:
+    reader = pipeline.ChainedPipeline(pending, reader)
+    reader.executor = pipeline.default_executor()
+  return reader
+
+
+def main(argv):
+  idf_reader = None
+  if "tf_idf" in FLAGS.stream_score:
+    if not FLAGS.idf_table:
+      raise app.UsageError("--idf_table is required to score tf-idf.")
+    idf_reader = table.KeywordReader(FLAGS.idf_table)
+
+  reader = fetch.get_fetching_pipeline(fetch.get_url_reader())
+  fetch_writer = get_writer("fetch")
+  if fetch_writer:
+    reader = pipeline.TeePipeline(reader, fetch_writer)
+
+  writer = db.ProtoDbWriter(
+      document_pb2.Document, FLAGS.stream_output, profile="documents",
+      **db.batch_options())
+  streaming = pipeline.TeePipeline(
+      chain(reader, get_stages(idf_reader)), writer)
+
+  if idf_reader:
+    with idf_reader:
+      streaming.run()
+  else:
+    streaming.run()
+
+
+if __name__ == "__main__":
+  flags.mark_flag_as_required("fetch_input")
+  flags.mark_flag_as_required("stream_output")
+  app.run(main)
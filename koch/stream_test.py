@@ -0,0 +1,110 @@
+"""Tests for koch.stream."""
+from __future__ import absolute_import
+
+import os
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from koch import db
+from koch import stream
+from koch import table
+from koch import testing
+from koch import text_rank
+from koch import tf_idf
+from koch import vocab
+from koch.proto import document_pb2
+
+FLAGS = flags.FLAGS
+
+
+def score(pipe, docs):
+  return {
+      key: {keyword.word: keyword for keyword in doc.keywords}
+      for doc in docs for key, doc in pipe(str(doc.url), doc)}
+
+
+class StreamTest(absltest.TestCase):
+
+  def setUp(self):
+    super(StreamTest, self).setUp()
+    self.tmp = self.create_tempdir().full_path
+    self.idf_table = os.path.join(self.tmp, "idf")
+    corpus = vocab.CorpusVocab()
+    for doc in testing.make_docs():
+      corpus.add(doc)
+    corpus.build().save(self.idf_table)
+
+  def get_stages(self, min_df):
+    return [
+      ("text_rank", text_rank.TextRankPipeline(None, None, True)),
+      ("tf_idf", tf_idf.TableTfIdfPipeline(
+          min_df, table.KeywordReader(self.idf_table), None)),
+    ]
+
+  def stream(self, min_df=0.0):
+    """Returns the streamed keywords of each document, and their words."""
+    stages = self.get_stages(min_df)
+    docs = testing.make_docs()
+    streaming = stream.chain(
+        db.DebugReader([str(doc.url) for doc in docs], docs), stages)
+    with stages[-1][1].idf_reader, streaming:
+      streamed = list(streaming)
+
+    words = [[keyword.word for keyword in doc.keywords] for doc in docs]
+    return {
+        key: {keyword.word: keyword for keyword in doc.keywords}
+        for key, doc in streamed}, words
+
+  def score_separately(self, min_df=0.0):
+    (_, ranking), (_, scoring) = self.get_stages(min_df)
+    with scoring.idf_reader:
+      return score(ranking.pipe, testing.make_docs()), score(scoring.pipe, testing.make_docs())
+
+  def test_scores_each_word_once(self):
+    _, words = self.stream()
+    for doc_words in words:
+      self.assertCountEqual(set(doc_words), doc_words)
+
+  def test_matches_stages_run_separately(self):
+    streamed, _ = self.stream()
+    ranked, scored = self.score_separately()
+    self.assertCountEqual(scored, streamed)
+    for key, keywords in streamed.iteritems():
+      self.assertCountEqual(ranked[key], keywords)
+      for word, keyword in keywords.iteritems():
+        self.assertEqual(ranked[key][word].text_rank, keyword.text_rank)
+        self.assertEqual(scored[key][word].tf_idf, keyword.tf_idf)
+        self.assertEqual(scored[key][word].doc_count, keyword.doc_count)
+
+  def test_drops_documents_without_tf_idf_keywords(self):
+    # Only beta and gamma are in over half of the documents.
+    streamed, _ = self.stream(min_df=0.5)
+    _, scored = self.score_separately(min_df=0.5)
+    self.assertCountEqual(scored, streamed)
+    self.assertNotIn("http://example.com/2", streamed)
+    for key, keywords in streamed.iteritems():
+      self.assertCountEqual(
+          scored[key], [word for word in keywords if keywords[word].doc_count])
+
+  @flagsaver.flagsaver
+  def test_persists_stage_outputs(self):
+    FLAGS.stream_persist = ["text_rank"]
+    FLAGS.text_rank_output = os.path.join(self.tmp, "text_rank")
+    streamed, _ = self.stream()
+
+    ranked, _ = self.score_separately()
+    reader = db.ProtoDbReader(document_pb2.Document, FLAGS.text_rank_output)
+    with reader:
+      persisted = {key: doc for key, doc in reader}
+
+    self.assertCountEqual(ranked, persisted)
+    for key, doc in persisted.iteritems():
+      self.assertCountEqual(ranked[key], [k.word for k in doc.keywords])
+      for keyword in doc.keywords:
+        self.assertEqual(0.0, keyword.tf_idf)
+
+
+if __name__ == "__main__":
+  absltest.main()
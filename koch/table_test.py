@@ -0,0 +1,65 @@
+"""Tests for koch.table."""
+from __future__ import absolute_import
+
+import os
+
+from absl.testing import absltest
+
+from koch import table
+from koch.proto import document_pb2
+
+
+def get_keywords():
+  keywords = [
+    document_pb2.Keyword(word=u"alpha", doc_count=3),
+    document_pb2.Keyword(word=u"beta", doc_count=1),
+    document_pb2.Keyword(word=u"gamma", doc_count=2),
+  ]
+  keywords[0].prior["spam"] = 0.25
+  keywords[2].prior["spam"] = 0.5
+  return keywords
+
+
+class TableTest(absltest.TestCase):
+
+  def setUp(self):
+    super(TableTest, self).setUp()
+    self.path = os.path.join(self.create_tempdir().full_path, "table")
+
+  def test_saves_and_loads(self):
+    table.from_keywords(get_keywords(), 4).save(self.path)
+    loaded = table.load(self.path)
+
+    self.assertEqual([u"alpha", u"beta", u"gamma"], loaded.words)
+    self.assertEqual(2, loaded.get_id(u"gamma"))
+    self.assertEqual(
+        [0, -1, 1], loaded.get_ids([u"alpha", u"x", u"beta"]).tolist())
+    self.assertEqual([3, 1, 2], loaded.columns["doc_count"].tolist())
+    self.assertEqual(
+        [0.25, 0.0, 0.5], loaded.columns[table.prior_column("spam")].tolist())
+    self.assertEqual(4, loaded.attributes["total_doc_count"])
+
+  def test_overwrites_saved_table(self):
+    table.from_keywords(get_keywords(), 4).save(self.path)
+    table.from_keywords(get_keywords()[1:], 5).save(self.path)
+    loaded = table.load(self.path)
+
+    self.assertEqual([u"beta", u"gamma"], loaded.words)
+    self.assertEqual([1, 2], loaded.columns["doc_count"].tolist())
+    self.assertEqual(5, loaded.attributes["total_doc_count"])
+
+  def test_keyword_reader_reads_keywords(self):
+    keywords = get_keywords()
+    table.from_keywords(keywords, 4).save(self.path)
+    with table.KeywordReader(self.path) as reader:
+      self.assertEqual(
+          [(str(keyword.word), keyword.doc_count) for keyword in keywords],
+          [(key, keyword.doc_count) for key, keyword in reader])
+      keyword = reader.get(u"gamma")
+      self.assertEqual(4, keyword.total_doc_count)
+      self.assertEqual(0.5, keyword.prior["spam"])
+      self.assertEqual(document_pb2.Keyword(), reader.get(u"missing"))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,52 @@
+"""Builds documents for tests."""
+from __future__ import absolute_import
+
+import random
+
+from koch.proto import document_pb2
+from koch.proto import util
+
+# A small corpus in which words are in from one to all but one document.
+TEXTS = [
+  "alpha beta gamma alpha delta",
+  "beta gamma epsilon",
+  "alpha zeta eta",
+  "gamma beta",
+]
+
+
+def make_doc(url, *texts, **kwargs):
+  """Returns a document with a blob of the whitespace separated words of each
+  of texts, with its words stored compactly if compact is set.
+  """
+  doc = document_pb2.Document(url=url)
+  for text in texts:
+    blob = doc.blobs.add(text=text)
+    for i, word in enumerate(text.split()):
+      blob.words.add(text=word, index=i)
+
+  if kwargs.get("compact"):
+    util.EncodeWords(doc)
+  return doc
+
+
+def make_docs(texts=TEXTS, compact=False):
+  """Returns a document of each of texts, with urls numbered in order."""
+  return [
+      make_doc("http://example.com/%d" % i, text, compact=compact)
+      for i, text in enumerate(texts)]
+
+
+def make_random_doc(seed, words=40, blobs=3, length=60, compact=False):
+  """Returns a document of random words, the same for the same seed."""
+  rng = random.Random(seed)
+  vocab = ["w%d" % i for i in range(words)]
+  return make_doc("http://example.com/%d" % seed, *[
+      " ".join(rng.choice(vocab) for _ in range(length))
+      for _ in range(blobs)], compact=compact)
+
+
+def copy(doc):
+  new_doc = document_pb2.Document()
+  new_doc.CopyFrom(doc)
+  return new_doc
@@ -1,62 +1,99 @@
 """Uses TextRank to score document keywords.
 
 TODO:
- - adjust edge builder
  - scores of isolated tokens
  - ranking evaluation
 """
+import collections
+import itertools
+import numpy as np
+
 from absl import app
 from absl import flags
 from absl import logging
+from scipy import sparse
 
 from koch import db
-from koch import parse
+from koch import outputs
 from koch import pipeline
 from koch.proto import document_pb2
 from koch.proto import text_rank_pb2
+from koch.proto import util
 
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string(
     "text_rank_output", None, "Output path to write TextRank results to.")
+flags.DEFINE_boolean(
+    "text_rank_vectorized", True, "Whether to use sparse matrix operations.")
+flags.DEFINE_string(
+    "text_rank_graph_output", None,
+    "Output path to also write the TextRank graph of each document to, with "
+    "its edges, in a second pass over the documents.")
 
 
 def add_tokens(graph, document):
-  tokens = {}
-  for i, blob in enumerate(document.blobs):
-    for word in blob.words:
-      token = tokens.get(word.text) or tokens.setdefault(
-          word.text, graph.tokens.add(text=word.text))
-      token.mentions.add(token=word.index, blob=i)
+  vocab, ids, blobs, indices = util.GetTokens(document)
+  tokens = [graph.tokens.add(text=word) for word in vocab]
+  # A stable sort groups the mentions of each token, keeping them in order.
+  for i in np.argsort(ids, kind="mergesort"):
+    tokens[ids[i]].mentions.add(token=int(indices[i]), blob=int(blobs[i]))
 
-  return tokens.values()
+  return tokens
 
 
-def get_adjacency_matrix(graph, edge_builder):
-  """Returns a weighted adjacency matrix. Adds edges to graph."""
+def get_edges(graph, window):
+  """Returns a map from token index pairs to co-occurrence weights.
+
+  Slides the window over the mentions of each blob once, adding 1 / distance
+  to both directions of every pair of mentions of distinct tokens that are
+  less than window words apart, skipping mentions at the same position.
+  """
+  blobs = collections.defaultdict(list)
+  for i, token in enumerate(graph.tokens):
+    for mention in token.mentions:
+      blobs[mention.blob].append((mention.token, i))
+
+  edges = collections.defaultdict(float)
+  for mentions in blobs.itervalues():
+    mentions.sort()
+    for k, (position, i) in enumerate(mentions):
+      for other_position, j in itertools.islice(mentions, k + 1, None):
+        distance = other_position - position
+        if distance >= window:
+          break
+        if i != j and distance > 0:
+          edges[i, j] += 1.0 / distance
+          edges[j, i] += 1.0 / distance
+
+  return edges
+
+
+def add_edges(graph, edges):
+  for (i, j), weight in sorted(edges.iteritems()):
+    graph.edges.add(
+        from_token=graph.tokens[i].text,
+        weight=weight,
+        to_token=graph.tokens[j].text)
+
+
+def get_adjacency_matrix(graph, edges):
+  """Returns a weighted adjacency matrix."""
   index = range(len(graph.tokens))
   matrix = [[0 for j in index] for i in index]
-  for i in index:
-    for j in index:
-      if i != j:
-        from_token = graph.tokens[i]
-        to_token = graph.tokens[j]
-        weight = edge_builder(from_token, to_token)
-        if weight:
-          matrix[i][j] = weight
-          graph.edges.add(
-              from_token=from_token.text, weight=weight, to_token=to_token.text)
+  for (i, j), weight in edges.iteritems():
+    matrix[i][j] = weight
 
   return matrix
 
 
-def get_text_rank_matrix(graph, edge_builder):
+def get_text_rank_matrix(graph, edges):
   """Returns an adjacency matrix reweighted by outgoing weights.
 
   r_{ij} = { w_{ij} / \sum_j w_{ij}, \sum_j w_{ij} > 0
            { 0,                      else
   """
-  matrix = get_adjacency_matrix(graph, edge_builder)
+  matrix = get_adjacency_matrix(graph, edges)
   index = range(len(matrix))
   outgoing = [0.0 for j in index]
   for i in index:
@@ -86,6 +123,38 @@ def text_rank(matrix, scores, damping_factor):
   return new_scores
 
 
+def get_sparse_adjacency_matrix(graph, edges):
+  """Returns a sparse weighted adjacency matrix."""
+  size = len(graph.tokens)
+  keys = edges.keys()
+  rows = [i for i, _ in keys]
+  cols = [j for _, j in keys]
+  weights = [edges[key] for key in keys]
+
+  return sparse.coo_matrix((weights, (rows, cols)), shape=(size, size)).tocsr()
+
+
+def get_sparse_text_rank_matrix(graph, edges):
+  """Returns a sparse adjacency matrix reweighted by outgoing weights."""
+  matrix = get_sparse_adjacency_matrix(graph, edges)
+  outgoing = np.asarray(matrix.sum(axis=0)).ravel()
+  scale = np.zeros(len(outgoing))
+  np.divide(1.0, outgoing, out=scale, where=outgoing > 0)
+
+  return matrix.dot(sparse.diags(scale)).tocsr()
+
+
+def sparse_text_rank(matrix, scores, damping_factor):
+  """Returns a vector of new TextRank scores using a sparse matrix product."""
+  return (1 - damping_factor) / matrix.shape[0] + (
+      damping_factor * matrix.dot(scores))
+
+
+def get_sparse_delta(scores, old_scores):
+  """Returns the L2 norm of the difference of two arrays."""
+  return np.linalg.norm(scores - old_scores)
+
+
 def get_delta(scores, old_scores):
   """Returns the L2 norm of the difference of two vectors."""
   squares = 0
@@ -102,12 +171,14 @@ def add_keywords(document, graph):
 
 class TextRankPipeline(pipeline.Pipeline):
 
-  def __init__(self, reader, writer=None):
+  def __init__(self, reader, writer=None, vectorized=True, keep_edges=False):
     super(TextRankPipeline, self).__init__(reader, writer)
     self.convergence_threshold = 0.0001
     self.damping_factor = 0.85
     self.max_iterations = 100
     self.window = 10
+    self.vectorized = vectorized
+    self.keep_edges = keep_edges
 
   def pipe(self, key, value):
     doc = value
@@ -118,12 +189,26 @@ class TextRankPipeline(pipeline.Pipeline):
 
   def build_graph(self, document):
     graph = text_rank_pb2.Graph()
-    tokens = add_tokens(graph, document)
-    matrix = get_text_rank_matrix(graph, self.build_edge)
-    scores = [1.0 / len(matrix) for _ in range(len(matrix))]
+    add_tokens(graph, document)
+    if not graph.tokens:
+      return graph
+
+    edges = get_edges(graph, self.window)
+    if self.keep_edges:
+      add_edges(graph, edges)
+
+    if self.vectorized:
+      matrix = get_sparse_text_rank_matrix(graph, edges)
+      scores = np.repeat(1.0 / len(graph.tokens), len(graph.tokens))
+      rank, delta_of = sparse_text_rank, get_sparse_delta
+    else:
+      matrix = get_text_rank_matrix(graph, edges)
+      scores = [1.0 / len(matrix) for _ in range(len(matrix))]
+      rank, delta_of = text_rank, get_delta
+
     for i in range(self.max_iterations):
-      new_scores = text_rank(matrix, scores, self.damping_factor)
-      delta = get_delta(new_scores, scores)
+      new_scores = rank(matrix, scores, self.damping_factor)
+      delta = delta_of(new_scores, scores)
       scores = new_scores
       if delta < self.convergence_threshold:
         break
@@ -131,27 +216,41 @@ class TextRankPipeline(pipeline.Pipeline):
       logging.warning("TextRank did not converge after %d iterations", i + 1)
       return graph
 
-    for token, score in zip(tokens, scores):
+    for token, score in zip(graph.tokens, scores):
       token.weight = score
 
     return graph
 
-  def build_edge(self, from_token, to_token):
-    weight = 0
-    to_mentions = {m.blob: m for m in to_token.mentions}
-    for from_mention in from_token.mentions:
-      if from_mention.blob in to_mentions:
-        distance = abs(from_mention.token - to_mentions[from_mention.blob].token)
-        weight += 1.0 / distance if 0 < distance < self.window else 0
 
-    return weight
+class GraphPipeline(TextRankPipeline):
+  """Builds the TextRank graph of each document, with its edges."""
 
+  def __init__(self, reader, writer=None, vectorized=True):
+    super(GraphPipeline, self).__init__(reader, writer, vectorized, True)
+
+  def pipe(self, key, value):
+    yield key, self.build_graph(value)
 
-def main(argv):
-  parser = db.ProtoDbReader(document_pb2.Document, FLAGS.parse_output)
-  writer = db.ProtoDbWriter(document_pb2.Document, FLAGS.text_rank_output)
 
-  TextRankPipeline(parser, writer).run()
+def main(argv):
+  parser = db.ProtoDbReader(
+      document_pb2.Document, FLAGS.parse_output, profile="documents",
+      **db.shard_options())
+  writer = db.ProtoDbWriter(
+      document_pb2.Document, FLAGS.text_rank_output, profile="documents",
+      **db.batch_options())
+
+  ranking = TextRankPipeline(parser, writer, FLAGS.text_rank_vectorized)
+  ranking.executor = pipeline.default_executor()
+  ranking.run()
+
+  if FLAGS.text_rank_graph_output:
+    graph_writer = db.ProtoDbWriter(
+        text_rank_pb2.Graph, FLAGS.text_rank_graph_output, profile="documents",
+        **db.batch_options())
+    graphing = GraphPipeline(parser, graph_writer, FLAGS.text_rank_vectorized)
+    graphing.executor = pipeline.default_executor()
+    graphing.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+"""Tests for koch.text_rank."""
+from __future__ import absolute_import
+
+import os
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from koch import db
+from koch import testing
+from koch import text_rank
+from koch.proto import document_pb2
+from koch.proto import text_rank_pb2
+
+FLAGS = flags.FLAGS
+
+
+def make_doc(*texts):
+  return testing.make_doc("http://example.com", *texts)
+
+
+def rank(doc, vectorized):
+  ranking = text_rank.TextRankPipeline(None, vectorized=vectorized)
+  (_, ranked), = ranking.pipe(doc.url, doc)
+  return [(keyword.word, keyword.text_rank) for keyword in ranked.keywords]
+
+
+class TextRankTest(absltest.TestCase):
+
+  def assertRanksAgree(self, doc):
+    dense = dict(rank(testing.copy(doc), False))
+    sparse = dict(rank(testing.copy(doc), True))
+    self.assertCountEqual(dense, sparse)
+    for word, score in dense.iteritems():
+      self.assertAlmostEqual(score, sparse[word], places=5, msg=word)
+
+  def test_sparse_matches_dense(self):
+    self.assertRanksAgree(make_doc(
+        "the quick brown fox jumps over the lazy dog",
+        "the dog sleeps while the fox runs"))
+
+  def test_sparse_matches_dense_on_random_docs(self):
+    for seed in range(5):
+      self.assertRanksAgree(testing.make_random_doc(seed))
+
+  def test_sparse_matches_dense_with_isolated_tokens(self):
+    self.assertRanksAgree(make_doc("alpha", "beta gamma", "delta"))
+
+  def test_compact_docs_rank_the_same(self):
+    for seed in range(5):
+      for vectorized in (True, False):
+        self.assertEqual(
+            rank(testing.make_random_doc(seed), vectorized),
+            rank(testing.make_random_doc(seed, compact=True), vectorized))
+
+  def test_empty_doc_has_no_keywords(self):
+    self.assertEqual([], rank(make_doc(), True))
+    self.assertEqual([], rank(make_doc(), False))
+
+
+class GetEdgesTest(absltest.TestCase):
+
+  def get_edges(self, doc, window):
+    graph = text_rank_pb2.Graph()
+    text_rank.add_tokens(graph, doc)
+    words = [token.text for token in graph.tokens]
+    return {
+        (words[i], words[j]): weight
+        for (i, j), weight in text_rank.get_edges(graph, window).iteritems()}
+
+  def get_pairwise_edges(self, doc, window):
+    """Returns edges compared mention by mention, as before windowing."""
+    edges = {}
+    for blob in doc.blobs:
+      for word in blob.words:
+        for other in blob.words:
+          distance = abs(word.index - other.index)
+          if word.text != other.text and 0 < distance < window:
+            key = word.text, other.text
+            edges[key] = edges.get(key, 0.0) + 1.0 / distance
+    return edges
+
+  def test_matches_pairwise_edges(self):
+    for seed in range(5):
+      doc = testing.make_random_doc(seed, words=15, length=30)
+      expected = self.get_pairwise_edges(doc, 4)
+      edges = self.get_edges(doc, 4)
+      self.assertCountEqual(expected, edges)
+      for key, weight in expected.iteritems():
+        self.assertAlmostEqual(weight, edges[key], msg=str(key))
+
+  def test_weights_by_distance(self):
+    edges = self.get_edges(make_doc("a b c"), 10)
+    self.assertEqual(1.0, edges["a", "b"])
+    self.assertEqual(0.5, edges["a", "c"])
+    self.assertEqual(0.5, edges["c", "a"])
+    self.assertNotIn(("a", "c"), self.get_edges(make_doc("a b c"), 2))
+
+  def test_skips_mentions_at_the_same_position(self):
+    doc = make_doc("a b")
+    doc.blobs[0].words.add(text="c", index=0)
+    edges = self.get_edges(doc, 10)
+    self.assertNotIn(("a", "c"), edges)
+    self.assertEqual(1.0, edges["c", "b"])
+
+
+class MainTest(absltest.TestCase):
+
+  def test_vectorized_by_default(self):
+    self.assertTrue(text_rank.TextRankPipeline(None).vectorized)
+    self.assertTrue(FLAGS["text_rank_vectorized"].default)
+
+  @flagsaver.flagsaver
+  def test_writes_keywords_and_graphs(self):
+    tmp = self.create_tempdir().full_path
+    FLAGS.parse_output = os.path.join(tmp, "parsed")
+    FLAGS.text_rank_output = os.path.join(tmp, "ranked")
+    FLAGS.text_rank_graph_output = os.path.join(tmp, "graphs")
+    docs = testing.make_docs()
+    with db.ProtoDbWriter(document_pb2.Document, FLAGS.parse_output) as writer:
+      for doc in docs:
+        writer.write(str(doc.url), doc)
+    text_rank.main([])
+
+    with db.ProtoDbReader(
+        document_pb2.Document, FLAGS.text_rank_output) as reader:
+      ranked = dict(reader)
+    with db.ProtoDbReader(
+        text_rank_pb2.Graph, FLAGS.text_rank_graph_output) as reader:
+      graphs = dict(reader)
+
+    self.assertCountEqual([str(doc.url) for doc in docs], ranked)
+    self.assertCountEqual(ranked, graphs)
+    for doc in docs:
+      key = str(doc.url)
+      self.assertEqual(
+          rank(testing.copy(doc), True),
+          [(k.word, k.text_rank) for k in ranked[key].keywords])
+      self.assertEqual(
+          {(t.text, t.weight) for t in graphs[key].tokens},
+          set(rank(testing.copy(doc), True)))
+      self.assertNotEmpty(graphs[key].edges)
+
+  @flagsaver.flagsaver
+  def test_graphs_are_opt_in(self):
+    tmp = self.create_tempdir().full_path
+    FLAGS.parse_output = os.path.join(tmp, "parsed")
+    FLAGS.text_rank_output = os.path.join(tmp, "ranked")
+    with db.ProtoDbWriter(document_pb2.Document, FLAGS.parse_output) as writer:
+      for doc in testing.make_docs():
+        writer.write(str(doc.url), doc)
+    text_rank.main([])
+    self.assertEqual(["parsed", "ranked"], sorted(os.listdir(tmp)))
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -3,41 +3,79 @@
 TODO:
  - tests
  - look into data loss
- - take idf as side input
  - add functions to construct pipelines
 """
 from __future__ import absolute_import
 
 import math
+import numpy as np
 
 from absl import app
 from absl import flags
 
 from koch import db
-from koch import parse
+from koch import outputs
 from koch import pipeline
+from koch import stats
+from koch import table
+from koch import vocab
 from koch.proto import document_pb2
 from koch.proto import util
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string("tmp_output", None, "Temporary output for idf calculation.")
 flags.DEFINE_string("tf_idf_output", None, "Output path to write tf-idf results to.")
+flags.DEFINE_string(
+    "idf_table", None,
+    "Output path to write an in-memory idf table to, next to --tmp_output if "
+    "unset.")
+flags.DEFINE_boolean(
+    "tf_idf_lookup", False,
+    "Whether to score documents by looking up each of their words in "
+    "--tmp_output, rather than in an idf table. Slower, but the vocab of the "
+    "corpus is never held in memory.")
+
+flags.DEFINE_boolean(
+    "tf_idf_vocab", False,
+    "Whether to score against the vocab of the parsed documents, rather than "
+    "computing the doc counts of words in a temporary output.")
 
 flags.DEFINE_float(
     "min_df", 0.0, "Minimum document frequency required of keywords.")
+flags.DEFINE_integer(
+    "combine_buffer_size", 500000,
+    "Number of words to combine keywords of in memory, 0 to combine each "
+    "value on disk. Buffered words are written back whenever the buffer "
+    "fills, so a frequent word is read and written about vocab size / buffer "
+    "size times; set this to at least the expected vocab size to write each "
+    "word once. Keywords are small, so memory grows by a few hundred bytes "
+    "per word.")
+
+
+def score(term_count, doc_term_count, term_doc_count, doc_count):
+  tf = term_count / float(doc_term_count)
+  idf = math.log(doc_count / float(term_doc_count))
+
+  return tf * idf
 
 
 class TfPipeline(pipeline.Pipeline):
 
   def pipe(self, key, value):
     doc = value
-    for word in set(w.text for w in util.IterWords(doc)):
+    vocab, _, _, _ = util.GetTokens(doc)
+    for word in vocab:
       new_doc = document_pb2.Document()
       new_doc.CopyFrom(doc)
       
       yield str(word), new_doc
 
 
+def get_table_path(path):
+  """Returns the default path of the idf table of the keywords at path."""
+  return path.rstrip("/") + ".idf"
+
+
 def GetCorpusSize(reader):
   with reader:
     return sum(1 for _ in reader)
@@ -45,13 +83,24 @@ def GetCorpusSize(reader):
 
 class IdfPipeline(pipeline.CombiningPipeline):
 
-  def __init__(self, reader, rewriter):
-    super(IdfPipeline, self).__init__(reader, rewriter)
-    self.n = GetCorpusSize(self.reader)
+  def __init__(
+      self, reader, rewriter, buffer_size=0, table_path=None, doc_count=None):
+    super(IdfPipeline, self).__init__(reader, rewriter, buffer_size)
+    self.n = doc_count if doc_count is not None else GetCorpusSize(self.reader)
+    self.table_path = table_path
+
+  def run(self):
+    if not self.table_path:
+      return super(IdfPipeline, self).run()
+
+    with self:
+      idf_table = table.from_keywords((k for _, k in self), self.n)
+    idf_table.save(self.table_path)
   
   def pipe(self, key, value):
     doc = value
-    for word in set(w.text for w in util.IterWords(doc)):
+    vocab, _, _, _ = util.GetTokens(doc)
+    for word in vocab:
       keyword = document_pb2.Keyword()
       keyword.word = word
       keyword.doc_count = 1
@@ -70,25 +119,20 @@ class IdfPipeline(pipeline.CombiningPipeline):
 
 class TfIdfPipeline(pipeline.CombiningPipeline):
 
-  def __init__(self, min_df, reader, rewriter):
-    super(TfIdfPipeline, self).__init__(reader, rewriter)
+  def __init__(self, min_df, reader, rewriter, buffer_size=0):
+    super(TfIdfPipeline, self).__init__(reader, rewriter, buffer_size)
     self.min_df = min_df
 
   def score(self, term_count, doc_term_count, term_doc_count, doc_count):
-    tf = term_count / float(doc_term_count)
-    idf = math.log(doc_count / float(term_doc_count))
-
-    return tf * idf
+    return score(term_count, doc_term_count, term_doc_count, doc_count)
   
   def pipe(self, key, value):
     doc, keyword = value
-    term_count = 0
-    doc_term_count = 0
-    for word in (w.text for w in util.IterWords(doc)):
-      doc_term_count += 1
-      if word == keyword.word:
-        term_count += 1
-        
+    vocab, counts = util.CountWords(doc)
+    term_counts = dict(zip(vocab, counts.tolist()))
+    term_count = term_counts.get(keyword.word, 0)
+    doc_term_count = int(counts.sum())
+
     keyword.term_count = term_count
     keyword.tf_idf = self.score(
         term_count, doc_term_count, keyword.doc_count, keyword.total_doc_count)
@@ -106,27 +150,161 @@ class TfIdfPipeline(pipeline.CombiningPipeline):
     return old_doc
 
 
+class KeywordIndex(object):
+  """Finds the keywords of a document by word, adding any that are missing.
+
+  Keywords already scored by other pipelines, such as TextRank, are filled in
+  rather than duplicated. count is the number of keywords looked up, so
+  pipelines can tell whether they scored any words themselves.
+  """
+
+  def __init__(self, doc):
+    self.doc = doc
+    self.keywords = {keyword.word: keyword for keyword in doc.keywords}
+    self.count = 0
+
+  def get(self, word):
+    self.count += 1
+    keyword = self.keywords.get(word)
+    if keyword is None:
+      keyword = self.keywords[word] = self.doc.keywords.add(word=word)
+    return keyword
+
+
+class DocumentTfIdfPipeline(pipeline.Pipeline):
+  """Scores every keyword of a document in a single pass.
+
+  Term counts are computed once per document and joined against the keywords
+  of idf_reader, so each document is written once with all of its keywords
+  instead of being copied and combined once per word.
+  """
+
+  def __init__(self, min_df, idf_reader, reader, writer=None):
+    super(DocumentTfIdfPipeline, self).__init__(reader, writer)
+    self.min_df = min_df
+    self.idf_reader = idf_reader
+
+  def __enter__(self):
+    self.idf_reader.__enter__()
+    return super(DocumentTfIdfPipeline, self).__enter__()
+
+  def __exit__(self, *args):
+    super(DocumentTfIdfPipeline, self).__exit__(*args)
+    self.idf_reader.__exit__(*args)
+
+  def pipe(self, key, value):
+    doc = value
+    vocab, counts = util.CountWords(doc)
+    term_counts = dict(zip(vocab, counts.tolist()))
+    doc_term_count = int(counts.sum())
+    scored = KeywordIndex(doc)
+    for word in sorted(term_counts):
+      keyword = self.idf_reader.get(str(word))
+      if not keyword.doc_count:
+        continue
+
+      if float(keyword.doc_count) / keyword.total_doc_count > self.min_df:
+        keyword.term_count = term_counts[word]
+        keyword.tf_idf = score(
+            keyword.term_count, doc_term_count,
+            keyword.doc_count, keyword.total_doc_count)
+        scored.get(word).MergeFrom(keyword)
+
+    if scored.count:
+      yield str(doc.url), doc
+
+
+class TableTfIdfPipeline(DocumentTfIdfPipeline):
+  """Scores every keyword of a document against a table of keywords.
+
+  The table is that of a table.KeywordReader, such as an idf table or a vocab.
+  The words of each document are looked up once as an array of ids and
+  filtered on their doc counts as arrays, so only kept keywords are built.
+  """
+
+  def pipe(self, key, value):
+    doc = value
+    keywords = self.idf_reader.get_table()
+    words, counts = util.CountWords(doc)
+    ids = keywords.get_ids(words)
+    known = ids >= 0
+    doc_counts = np.zeros(len(words), dtype=np.int64)
+    doc_counts[known] = keywords.columns["doc_count"][ids[known]]
+
+    total_doc_count = keywords.attributes["total_doc_count"]
+    keep = doc_counts > 0
+    keep[keep] = doc_counts[keep] / float(total_doc_count) > self.min_df
+
+    doc_term_count = int(counts.sum())
+    scored = KeywordIndex(doc)
+    for i in sorted(np.flatnonzero(keep), key=words.__getitem__):
+      keyword = scored.get(words[i])
+      keyword.term_count = int(counts[i])
+      keyword.doc_count = int(doc_counts[i])
+      keyword.total_doc_count = total_doc_count
+      for label in keywords.attributes["labels"]:
+        column = keywords.columns[table.prior_column(label)]
+        keyword.prior[label] = column[ids[i]]
+      keyword.tf_idf = score(
+          keyword.term_count, doc_term_count,
+          keyword.doc_count, keyword.total_doc_count)
+
+    if scored.count:
+      yield str(doc.url), doc
+
+
 def main(argv):
-  parser = db.ProtoDbReader(document_pb2.Document, FLAGS.parse_output)
+  parser = db.ProtoDbReader(
+      document_pb2.Document, FLAGS.parse_output, profile="documents")
+  tf_idf_writer = db.ProtoDbWriter(
+      document_pb2.Document, FLAGS.tf_idf_output, profile="documents",
+      **db.batch_options())
+
+  if FLAGS.tf_idf_vocab:
+    vocab.load_or_compute(FLAGS.parse_output, parser)
+    TableTfIdfPipeline(
+        FLAGS.min_df,
+        table.KeywordReader(vocab.get_path(FLAGS.parse_output)),
+        parser,
+        tf_idf_writer).run()
+    return
+
+  if not FLAGS.tmp_output:
+    raise app.UsageError("--tmp_output is required without --tf_idf_vocab.")
+
+  corpus = stats.load_or_compute(FLAGS.parse_output, parser)
+
+  idf_table = None
+  if not FLAGS.tf_idf_lookup:
+    idf_table = FLAGS.idf_table or get_table_path(FLAGS.tmp_output)
 
   idf_rewriter = db.Rewriter(
-      db.ProtoDbReader(document_pb2.Keyword, FLAGS.tmp_output),
-      db.ProtoDbWriter(document_pb2.Keyword, FLAGS.tmp_output))
-  IdfPipeline(parser, idf_rewriter).run()
-
-  tf_idf_rewriter = db.Rewriter(
-      db.ProtoDbReader(document_pb2.Document, FLAGS.tf_idf_output),
-      db.ProtoDbWriter(document_pb2.Document, FLAGS.tf_idf_output))
-  TfIdfPipeline(
+      db.ProtoDbReader(
+          document_pb2.Keyword, FLAGS.tmp_output, profile="keywords"),
+      db.ProtoDbWriter(
+          document_pb2.Keyword, FLAGS.tmp_output, profile="keywords",
+          **db.batch_options()))
+  IdfPipeline(
+      parser, idf_rewriter, FLAGS.combine_buffer_size, idf_table,
+      corpus.doc_count).run()
+
+  if idf_table:
+    TableTfIdfPipeline(
+        FLAGS.min_df,
+        table.KeywordReader(idf_table),
+        parser,
+        tf_idf_writer).run()
+    return
+
+  DocumentTfIdfPipeline(
       FLAGS.min_df,
-      db.JoiningReader(
-          TfPipeline(parser),
-          db.ProtoDbReader(document_pb2.Keyword, FLAGS.tmp_output)),
-      tf_idf_rewriter).run()
+      db.ProtoDbReader(
+          document_pb2.Keyword, FLAGS.tmp_output, profile="keywords"),
+      parser,
+      tf_idf_writer).run()
 
 
 if __name__ == "__main__":
   flags.mark_flag_as_required("parse_output")
-  flags.mark_flag_as_required("tmp_output")
   flags.mark_flag_as_required("tf_idf_output")
   app.run(main)
@@ -0,0 +1,94 @@
+"""Tests for koch.tf_idf."""
+from __future__ import absolute_import
+
+import os
+
+from absl import flags
+from absl.testing import absltest
+from absl.testing import flagsaver
+
+from koch import db
+from koch import testing
+from koch import tf_idf
+from koch import vocab
+from koch.proto import document_pb2
+
+FLAGS = flags.FLAGS
+
+
+class TfIdfTest(absltest.TestCase):
+
+  def setUp(self):
+    super(TfIdfTest, self).setUp()
+    self.tmp = self.create_tempdir().full_path
+    self.parse_output = self.write_docs("parsed")
+
+  def write_docs(self, name, compact=False):
+    path = os.path.join(self.tmp, name)
+    with db.ProtoDbWriter(document_pb2.Document, path) as writer:
+      for doc in testing.make_docs(compact=compact):
+        writer.write(str(doc.url), doc)
+    return path
+
+  @flagsaver.flagsaver
+  def score(self, name, **flag_values):
+    """Runs tf_idf.main with flag_values, returning its scored keywords."""
+    FLAGS.parse_output = self.parse_output
+    FLAGS.tmp_output = os.path.join(self.tmp, name + ".tmp")
+    FLAGS.tf_idf_output = os.path.join(self.tmp, name)
+    for flag, value in flag_values.iteritems():
+      setattr(FLAGS, flag, value)
+    tf_idf.main([])
+
+    reader = db.ProtoDbReader(document_pb2.Document, FLAGS.tf_idf_output)
+    with reader:
+      return {
+          key: [
+              (keyword.word, keyword.term_count, keyword.doc_count,
+               round(keyword.tf_idf, 6))
+              for keyword in doc.keywords]
+          for key, doc in reader}
+
+  def test_scores_keywords(self):
+    scored = self.score("table")
+    self.assertEqual([
+      (u"alpha", 2, 2, round(0.4 * 0.693147, 6)),
+      (u"beta", 1, 3, round(0.2 * 0.287682, 6)),
+      (u"delta", 1, 1, round(0.2 * 1.386294, 6)),
+      (u"gamma", 1, 3, round(0.2 * 0.287682, 6)),
+    ], scored["http://example.com/0"])
+    self.assertTrue(os.path.isdir(
+        tf_idf.get_table_path(os.path.join(self.tmp, "table.tmp"))))
+
+  def test_lookup_matches_table(self):
+    self.assertEqual(
+        self.score("table"), self.score("lookup", tf_idf_lookup=True))
+
+  def test_vocab_matches_table(self):
+    expected = self.score("table")
+    self.assertEqual(expected, self.score("vocab", tf_idf_vocab=True))
+    self.assertTrue(os.path.isdir(vocab.get_path(self.parse_output)))
+
+  def test_combine_buffer_sizes_agree(self):
+    expected = self.score("unbuffered", combine_buffer_size=0)
+    for buffer_size in (1, 3):
+      scored = self.score(
+          "buffered%d" % buffer_size, combine_buffer_size=buffer_size)
+      self.assertEqual(expected, scored)
+
+  def test_compact_documents_score_the_same(self):
+    expected = self.score("table")
+    self.parse_output = self.write_docs("parsed_compact", compact=True)
+    self.assertEqual(expected, self.score("compact"))
+    self.assertEqual(expected, self.score("compact_lookup", tf_idf_lookup=True))
+
+  def test_min_df_drops_documents(self):
+    scored = self.score("min_df", min_df=0.5)
+    self.assertNotIn("http://example.com/2", scored)
+    self.assertEqual(
+        [u"beta", u"gamma"],
+        [word for word, _, _, _ in scored["http://example.com/3"]])
+
+
+if __name__ == "__main__":
+  absltest.main()
@@ -0,0 +1,73 @@
+"""Assigns corpus wide integer ids to words, saved alongside parsed documents.
+
+A vocab is a table of the words of a corpus in sorted order, so the id of a
+word is stable for a given corpus, with the number of documents containing
+each word. It has the columns and attributes of an idf table, so it can be
+read as one by a table.KeywordReader.
+"""
+from __future__ import absolute_import
+
+import collections
+import numpy as np
+
+from koch import stats
+from koch import table
+from koch.proto import util
+
+
+def get_path(path):
+  """Returns the path of the vocab of the database at path."""
+  return path.rstrip("/") + ".vocab"
+
+
+class CorpusVocab(object):
+  """Counts the documents containing each word of a corpus."""
+
+  def __init__(self):
+    self.doc_count = 0
+    self.doc_counts = collections.Counter()
+
+  def add(self, doc):
+    self.doc_count += 1
+    vocab, _, _, _ = util.GetTokens(doc)
+    self.doc_counts.update(vocab)
+
+  def build(self):
+    """Returns a table of the words in sorted order and their doc counts."""
+    words = sorted(self.doc_counts)
+    doc_counts = np.array(
+        [self.doc_counts[word] for word in words], dtype=np.float64)
+    return table.Table(words, {"doc_count": doc_counts}, {
+      "total_doc_count": self.doc_count,
+      "labels": [],
+    })
+
+  def save(self, path):
+    self.build().save(path)
+
+
+def load_or_compute(path, reader):
+  """Returns the vocab of the database at path, scanning it if needed."""
+  return stats.load_or_compute_corpus(
+      get_path(path), reader, CorpusVocab, table.load)
+
+
+class VocabWriter(stats.CorpusWriter):
+  """Wraps a writer of documents, saving the vocab of their words on exit.
+
+  If stats_path is set, the number of words is also recorded as the vocab_size
+  of the statistics saved there, which must be saved first.
+  """
+
+  corpus_type = CorpusVocab
+
+  def __init__(self, writer, path, stats_path=None):
+    super(VocabWriter, self).__init__(writer, path)
+    self.stats_path = stats_path
+
+  def __exit__(self, *args):
+    super(VocabWriter, self).__exit__(*args)
+    if self.stats_path and (not args or args[0] is None):
+      corpus = stats.load(self.stats_path)
+      corpus.vocab_size = len(self.corpus.doc_counts)
+      corpus.save(self.stats_path)